@@ -0,0 +1,23 @@
+"""
+Gunicorn settings, used as `gunicorn --config=gunicorn.conf.py prolife.wsgi:application`.
+
+Workers run requests in threads, so a slow report or export holds up one thread instead of a whole
+worker process, while the others keep serving the admin. Every thread keeps its own database
+connection for CONN_MAX_AGE seconds: workers * threads of them, plus the Celery workers', must fit
+in PostgreSQL's max_connections (100 by default). The default number of workers is capped so their
+threads stay within GUNICORN_DB_CONNECTIONS.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# The CPUs this process may run on, the host's count overstates a container limited to a CPU set
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+# Leaves room for the Celery workers and maintenance within PostgreSQL's default max_connections
+db_connections = int(os.environ.get('GUNICORN_DB_CONNECTIONS', 60))
+workers = int(os.environ.get('GUNICORN_WORKERS', max(min(cpus * 2 + 1, db_connections // threads), 1)))
+# Threaded workers keep heartbeating while a request runs, so this only restarts hung workers
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Long exports stream for a while, let them finish on restarts
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
@@ -1,27 +1,41 @@
-from decimal import Decimal
+import codecs
+import json
 
 from django.contrib import admin
 from django.contrib.admin import register
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.forms import ModelForm, ValidationError
 from django.forms.models import BaseInlineFormSet
 from django.conf import settings
-
-from prolife.core.tasks import send_email
-from prolife.core.email_service import ORDER_CREATED_EMAIL
+from django.http import Http404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+
+from prolife.core.exports import order_lines_csv_response
+from prolife.core.forms import OrderImportForm
+from prolife.core.imports import OrderImportError, OrderImporter, read_rows
+from prolife.core.pagination import KeysetPaginator
+from prolife.core.search import get_product_version, search_customers, search_products
+from prolife.core.transitions import transition_orders
 
 from prolife.core.models import (
     Product,
     Customer,
     Order,
     OrderedProduct,
+    OutboxMessage,
 )
 
 
 class CustomModelAdmin(admin.ModelAdmin):
     exclude_list_display = []
+    # Maximum number of queries a full changelist page may issue, enforced by the tests
+    changelist_query_budget = None
 
     def __init__(self, model, admin_site):
-        self.list_display = [field.name for field in model._meta.fields if field.name not in self.exclude_list_display]
+        if self.list_display == admin.ModelAdmin.list_display:
+            self.list_display = [field.name for field in model._meta.fields if field.name not in self.exclude_list_display]
         super(CustomModelAdmin, self).__init__(model, admin_site)
 
 
@@ -29,11 +43,30 @@ class CustomModelAdmin(admin.ModelAdmin):
 class ProductAdmin(CustomModelAdmin):
     exclude_list_display = ['id']
     search_fields = ['name', 'sku']
+    changelist_query_budget = 5
+
+    def autocomplete_view(self, request):
+        request.is_autocomplete = True
+        return super().autocomplete_view(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return search_products(queryset, search_term, truncate=getattr(request, 'is_autocomplete', False)), False
 
 
 @register(Customer)
 class CustomerAdmin(CustomModelAdmin):
+    exclude_list_display = ['email_normalized', 'phone_digits', 'mobile_digits']
     search_fields = ['name', 'phone_number', 'email']
+    changelist_query_budget = 5
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return search_customers(queryset, search_term), False
 
 
 # TODO: Move to forms.py
@@ -48,13 +81,71 @@ class AtLeastOneRequiredInlineFormSet(BaseInlineFormSet):
             raise ValidationError('At least one item required.')
 
 
+class LabelledAutocompleteSelect(AutocompleteSelect):
+    """Autocomplete widget taking the label of the selected option from `labels` instead of a query."""
+    labels = None
+
+    def optgroups(self, name, value, attr=None):
+        if self.labels is None:
+            return super().optgroups(name, value, attr)
+        default = (None, [], 0)
+        if not self.is_required:
+            default[1].append(self.create_option(name, '', '', False, 0))
+        for option_value in value:
+            if str(option_value) in self.labels:
+                default[1].append(
+                    self.create_option(name, option_value, self.labels[str(option_value)], True, len(default[1]))
+                )
+        return [default]
+
+
+class OrderedProductInlineFormSet(AtLeastOneRequiredInlineFormSet):
+
+    @cached_property
+    def forms(self):
+        """Label the selected products of every line at once, rather than with a query per line."""
+        forms = super().forms
+        labels = {
+            str(form.instance.product_id): str(form.instance.product)
+            for form in forms if form.instance.product_id is not None
+        }
+        selected = {str(form['product'].value()) for form in forms} - set(labels)
+        missing = [product_id for product_id in selected if product_id.isdigit()]
+        labels.update((str(product.pk), str(product)) for product in Product.objects.filter(pk__in=missing))
+        for form in forms:
+            widget = form.fields['product'].widget
+            getattr(widget, 'widget', widget).labels = labels
+        return forms
+
+    def get_saved_prices(self):
+        """
+        JSON {line id: {product, unit_price}} of the saved lines, totalled by the order form at the
+        price they were saved with rather than the current product price.
+        """
+        return json.dumps({
+            form.instance.pk: {
+                'product': getattr(form.instance, '_snapshot_product_id', form.instance.product_id),
+                'unit_price': str(form.instance.unit_price),
+            }
+            for form in self.forms if form.instance.pk is not None
+        })
+
+
 class OrderedProductInline(admin.TabularInline):
     template = 'admin/ordered_product_tabular.html'
     model = OrderedProduct
     raw_id_fields = ['product']
     autocomplete_fields = ['product']
     extra = 0
-    formset = AtLeastOneRequiredInlineFormSet
+    formset = OrderedProductInlineFormSet
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'product':
+            kwargs['widget'] = LabelledAutocompleteSelect(db_field.remote_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 # TODO: Move to forms.py
@@ -76,17 +167,28 @@ class OrderForm(ModelForm):
 
 
 @register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(CustomModelAdmin):
 
     form = OrderForm
     inlines = [OrderedProductInline]
     list_display = ['id', 'status', 'get_sales_rep_email', 'customer']
+    list_select_related = ['sales_rep', 'customer']
     list_filter = ['status']
+    ordering = ('-created_at', '-id')
+    paginator = KeysetPaginator
+    # The unfiltered total would need a COUNT(*) of the whole table on every page
+    show_full_result_count = False
+    changelist_query_budget = 5
 
     search_fields = ['id', 'customer__email']
 
     autocomplete_fields = ('customer',)
 
+    actions = ['export_order_lines', 'mark_processing', 'mark_awaiting_customer_response', 'mark_dispatched']
+
+    def has_transition_permission(self, request):
+        return request.user.is_superuser
+
     def get_readonly_fields(self, request, obj=None):
         if not request.user.is_superuser:
             return self.readonly_fields + ('status',)
@@ -95,9 +197,40 @@ class OrderAdmin(admin.ModelAdmin):
     def get_sales_rep_email(self, obj):
         return obj.sales_rep.email
 
-    get_sales_rep_email.admin_order_field = 'sales_rep_email'  # Allows column order sorting
+    get_sales_rep_email.admin_order_field = 'sales_rep__email'  # Allows column order sorting
     get_sales_rep_email.short_description = 'Sales rep email'  # Renames column head
 
+    def export_order_lines(self, request, queryset):
+        return order_lines_csv_response(queryset)
+
+    export_order_lines.short_description = 'Export order lines of selected orders as CSV'
+
+    def transition(self, request, queryset, status):
+        selected = queryset.count()
+        moved = transition_orders(queryset, status)
+        message = f'{moved} orders marked as {dict(Order.STATUS_CHOICES)[status].lower()}.'
+        if moved < selected:
+            message += f" {selected - moved} orders can't be moved there from their status and were left as they were."
+        self.message_user(request, message)
+
+    def mark_processing(self, request, queryset):
+        self.transition(request, queryset, Order.PROCESSING)
+
+    mark_processing.short_description = 'Mark selected orders as processing'
+    mark_processing.allowed_permissions = ('transition',)
+
+    def mark_awaiting_customer_response(self, request, queryset):
+        self.transition(request, queryset, Order.AWAITING_CUSTOMER_RESPONSE)
+
+    mark_awaiting_customer_response.short_description = 'Mark selected orders as awaiting customer response'
+    mark_awaiting_customer_response.allowed_permissions = ('transition',)
+
+    def mark_dispatched(self, request, queryset):
+        self.transition(request, queryset, Order.DISPATCHED)
+
+    mark_dispatched.short_description = 'Mark selected orders as dispatched'
+    mark_dispatched.allowed_permissions = ('transition',)
+
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         if request.user.is_superuser:
@@ -114,41 +247,90 @@ class OrderAdmin(admin.ModelAdmin):
         form.request = request
         return form
 
-    def response_add(self, request, obj, post_url_continue=None):
-        self.send_order_created_email(obj)
-        return super().response_add(request, obj)
-
-    def send_order_created_email(self, order):
-        ordered_products = []
-        total_amount = Decimal('0.00')
-        for ordered_product in OrderedProduct.objects.filter(order=order).select_related('product'):
-            amount = ordered_product.quantity * ordered_product.product.price
-            ordered_products.append({
-                'name': ordered_product.product.name,
-                'quantity': ordered_product.quantity,
-                'amount': amount,
-            })
-            total_amount += amount
-        customer = order.customer
-        send_email.delay(
-            ORDER_CREATED_EMAIL,
-            settings.ORDER_CREATED_TO_EMAILS + [order.sales_rep.email],
-            settings.ORDER_CREATED_CC_EMAILS,
-            {
-                'order_url': order.url,
-                'order_id': order.id,
-                'order_notes': order.notes,
-                'products': ordered_products,
-                'customer_address': f'{customer.address}, {customer.city}, {customer.county}, {customer.postcode}',
-                'customer_phone': customer.phone_number,
-                'customer_mobile': customer.mobile,
-                'customer_email': customer.email,
-                'total_amount': f'£{total_amount} (EX VAT)',
-                'sales_rep_id': order.sales_rep.get_full_name(),
-            },
-        )
+    def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
+        context['product_prices_url'] = f'{reverse("product_prices")}?v={get_product_version()}'
+        return super().render_change_form(request, context, add, change, form_url, obj)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if not change:
+            # Written in the admin's transaction, the email is only sent once the order is committed
+            OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': form.instance.pk})
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='core_order_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not request.user.is_superuser:
+            raise Http404
+        importer = None
+        form = OrderImportForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            importer = OrderImporter(
+                default_sales_rep=request.user,
+                notify=form.cleaned_data['notify'],
+                dry_run=form.cleaned_data['dry_run'],
+            )
+            try:
+                importer.run(read_rows(codecs.iterdecode(form.cleaned_data['file'], 'utf-8-sig'), form.cleaned_data['format']))
+            except (OrderImportError, UnicodeDecodeError) as e:
+                # The batches before a decoding error are imported and still reported
+                form.add_error('file', str(e))
+        return TemplateResponse(request, 'admin/core/order/import.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import orders',
+            'form': form,
+            'importer': importer,
+        })
 
     class Media:
         js = ('js/order.js',
             # '//ajax.googleapis.com/ajax/libs/jquery/1.9.1/jquery.min.js',  # jquery
         )
+
+
+class OutboxStateFilter(admin.SimpleListFilter):
+    title = 'state'
+    parameter_name = 'state'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('pending', 'Pending'),
+            ('delivered', 'Delivered'),
+            ('failed', 'Failed'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'pending':
+            return queryset.filter(delivered_at__isnull=True, attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+        if self.value() == 'delivered':
+            return queryset.filter(delivered_at__isnull=False)
+        if self.value() == 'failed':
+            return queryset.filter(delivered_at__isnull=True, attempts__gte=settings.OUTBOX_MAX_ATTEMPTS)
+        return queryset
+
+
+@register(OutboxMessage)
+class OutboxMessageAdmin(CustomModelAdmin):
+    list_filter = [OutboxStateFilter, 'event']
+    paginator = KeysetPaginator
+    show_full_result_count = False
+    readonly_fields = ['event', 'payload', 'created_at', 'relayed_at', 'attempts', 'next_attempt_at', 'claimed_at',
+                       'delivered_at']
+    actions = ['retry_messages']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def retry_messages(self, request, queryset):
+        retried = queryset.filter(delivered_at__isnull=True).update(attempts=0, next_attempt_at=None)
+        self.message_user(request, f'{retried} messages will be relayed again.')
+
+    retry_messages.short_description = 'Retry selected failed messages'
+    retry_messages.allowed_permissions = ('delete',)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     name = 'prolife.core'
     verbose_name = 'Orders'
+
+    def ready(self):
+        from prolife.core import connections, signals  # noqa: F401
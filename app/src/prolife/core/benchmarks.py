@@ -0,0 +1,404 @@
+"""
+Micro and macro benchmarks run by `manage.py benchmark`.
+
+Each benchmark is a function registered with `@benchmark(name)` that takes the parsed command options
+and returns a dict of measurements; timings are produced by `measure`.
+"""
+import random
+import socketserver
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+from decimal import Decimal
+
+from constance import config
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.signals import request_finished, request_started
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from prolife.core.email_service import ORDER_CREATED_EMAIL, EmailService, close_pooled_connection
+from prolife.core.models import Customer, MonthlySalesRollup, Order
+from prolife.core.reports import store_sales_report
+from prolife.core.synthetic import get_max_id, seed_customers
+from prolife.core.tasks import send_email_batch
+from prolife.utils import PivotReport, get_formatted_report
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat=5):
+    """Call `func` `repeat` times and return the best and median wall time in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'best': min(timings),
+        'median': statistics.median(timings),
+        'repeat': repeat,
+    }
+
+
+def get_report_rows(count, entities=1000, seed=0):
+    rng = random.Random(seed)
+    return [
+        (rng.randint(1, 12), Decimal(rng.randint(1, 1000000)) / 100, f'Entity {rng.randrange(entities)}')
+        for _ in range(count)
+    ]
+
+
+@benchmark('pivot')
+def bench_pivot(options):
+    """Formatted report + customer ranking: nested dicts and sum-in-sort-key vs `PivotReport`."""
+    rows = get_report_rows(options['rows'])
+
+    def formatted_report():
+        report = get_formatted_report(rows)
+        return {k: v for k, v in sorted(report.items(), key=lambda kv: sum(kv[1].values()), reverse=True)}
+
+    def pivot_report():
+        return PivotReport(rows).top()
+
+    expected = formatted_report()
+    result = pivot_report().as_dict()
+    if result != expected or list(result) != list(expected):
+        raise AssertionError('PivotReport differs from get_formatted_report')
+
+    baseline = measure(formatted_report, options['repeat'])
+    pivot = measure(pivot_report, options['repeat'])
+    top_10 = measure(lambda: PivotReport(rows).top(10), options['repeat'])
+    return {
+        'rows': len(rows),
+        'get_formatted_report': baseline,
+        'pivot_report': pivot,
+        'pivot_report_top_10': top_10,
+        'speedup': baseline['median'] / pivot['median'],
+    }
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # Stands in for the TCP + TLS handshake and login of a real server
+        time.sleep(self.server.connect_latency)
+        self.wfile.write(b'220 localhost ESMTP stand-in\r\n')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b'\r\n') != b'.':
+                    continue
+                in_data = False
+                self.server.count_message()
+                reply = b'250 OK'
+            else:
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    reply = b'250-localhost\r\n250 8BITMIME'
+                elif command == b'DATA':
+                    in_data = True
+                    reply = b'354 End data with <CR><LF>.<CR><LF>'
+                elif command == b'QUIT':
+                    self.wfile.write(b'221 Bye\r\n')
+                    return
+                else:
+                    reply = b'250 OK'
+            self.wfile.write(reply + b'\r\n')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Local SMTP server that accepts and discards messages, for benchmarking the sending side."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_latency=0):
+        super().__init__(('127.0.0.1', 0), SMTPStandInHandler)
+        self.connect_latency = connect_latency
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count_message(self):
+        with self._lock:
+            self.messages += 1
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def get_order_email_context(lines):
+    products = [
+        {'name': f'Product {i}', 'quantity': i % 5 + 1, 'amount': Decimal(i % 5 + 1) * Decimal('9.99')}
+        for i in range(lines)
+    ]
+    return {
+        'order_url': 'https://example.com/core/order/1/change/',
+        'order_id': 1,
+        'order_notes': 'Please deliver before noon.',
+        'products': products,
+        'customer_address': '1 High Street, Leeds, West Yorkshire, LS1 1AA',
+        'customer_phone': '+441234567890',
+        'customer_mobile': None,
+        'customer_email': 'customer@example.com',
+        'total_amount': f'£{sum(product["amount"] for product in products)} (EX VAT)',
+        'sales_rep_id': 'Sales Rep',
+    }
+
+
+@benchmark('email_send')
+def bench_email_send(options):
+    """Order-created emails through a local SMTP stand-in: a connection per message vs pooled batches."""
+    emails = [
+        (ORDER_CREATED_EMAIL, [f'rep{i}@example.com'], [], get_order_email_context(5), None)
+        for i in range(options['messages'])
+    ]
+
+    def per_message():
+        for email_config, to_list, cc_list, custom_kwargs, from_email in emails:
+            EmailService(email_config).send(to_list, cc_list, from_email=from_email, **custom_kwargs)
+
+    def batched():
+        send_email_batch(emails)
+        close_pooled_connection()
+
+    with SMTPStandIn(options['smtp_latency']) as server, override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+        EMAIL_HOST='127.0.0.1',
+        EMAIL_PORT=server.port,
+        EMAIL_HOST_USER='',
+        EMAIL_HOST_PASSWORD='',
+        EMAIL_USE_TLS=False,
+        EMAIL_USE_SSL=False,
+    ):
+        results = {}
+        for name, func in (('per_message', per_message), ('batched', batched)):
+            results[name] = measure(func, options['repeat'])
+            results[name]['messages_per_second'] = len(emails) / results[name]['median']
+        if server.messages != 2 * options['repeat'] * len(emails):
+            raise AssertionError(f'The SMTP stand-in received {server.messages} messages')
+    return {
+        'messages': len(emails),
+        'smtp_latency': options['smtp_latency'],
+        **results,
+        'speedup': results['per_message']['median'] / results['batched']['median'],
+    }
+
+
+@benchmark('email_render')
+def bench_email_render(options):
+    """Rendering a 50-line order email: two render_to_string passes vs the compiled `EmailService.render`."""
+    context = get_order_email_context(50)
+    email_service = EmailService(ORDER_CREATED_EMAIL)
+    template_name = ORDER_CREATED_EMAIL['template_name']
+
+    def render_to_strings():
+        email_service.format_text(ORDER_CREATED_EMAIL['subject'], **context)
+        render_to_string(f'core/email/{template_name}.txt', context=context)
+        render_to_string(f'core/email/{template_name}.html', context=context)
+
+    def compiled_render():
+        email_service.render(**context)
+
+    results = {}
+    for name, func in (('render_to_string', render_to_strings), ('compiled', compiled_render)):
+        results[name] = measure(lambda: [func() for _ in range(options['messages'])], options['repeat'])
+        results[name]['emails_per_second'] = options['messages'] / results[name]['median']
+    return {
+        'lines': 50,
+        'emails': options['messages'],
+        'debug': settings.DEBUG,
+        **results,
+        'speedup': results['render_to_string']['median'] / results['compiled']['median'],
+    }
+
+
+@benchmark('customer_search')
+def bench_customer_search(options):
+    """Customer autocomplete requests over seeded customers: icontains over `search_fields` vs `search_customers`."""
+    customer_admin = site._registry[Customer]
+    factory = RequestFactory()
+    search_terms = {
+        'name': 'c4ca',
+        'name_prefix': 'Ec',
+        'email': 'customer123456@',
+        'phone_number': '07000 123456',
+    }
+    results = {}
+    with transaction.atomic():
+        seed_customers(options['customers'], start=get_max_id('core_customer'))
+        user = User.objects.create_superuser('benchmark', 'benchmark@example.com', None)
+
+        def autocomplete(search_term):
+            request = factory.get('/core/customer/autocomplete/', {'term': search_term})
+            request.user = user
+            response = customer_admin.autocomplete_view(request)
+            if response.status_code != 200:
+                raise AssertionError(f'Autocomplete for {search_term!r} returned {response.status_code}')
+
+        for name, search_term in search_terms.items():
+            with mock.patch.object(type(customer_admin), 'get_search_results', admin.ModelAdmin.get_search_results):
+                baseline = measure(lambda: autocomplete(search_term), options['repeat'])
+            indexed = measure(lambda: autocomplete(search_term), options['repeat'])
+            results[name] = {
+                'search_term': search_term,
+                'search_fields': baseline,
+                'indexed': indexed,
+                'speedup': baseline['median'] / indexed['median'],
+            }
+        transaction.set_rollback(True)
+    return {
+        'customers': options['customers'],
+        **results,
+    }
+
+
+@contextmanager
+def superuser_client():
+    """Yield a test client logged in as a superuser who only exists until the block exits."""
+    with transaction.atomic(), override_settings(PROFILING_SAMPLE_RATE=0):
+        client = Client()
+        client.force_login(User.objects.create_superuser('benchmark', 'benchmark@example.com', None))
+        yield client
+        transaction.set_rollback(True)
+
+
+def measure_get(client, url, repeat):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise AssertionError(f'GET {url} returned {response.status_code}')
+    return measure(lambda: client.get(url), repeat)
+
+
+@benchmark('report_queries')
+def bench_report_queries(options):
+    """The sales report of the configured year: live `Order` aggregations, their formatting and the rollup queries."""
+    year = config.YEAR
+    by_sales_rep = list(Order.get_dispatched_order_in_year_by_sales_rep(year))
+    by_customers = list(Order.get_dispatched_order_in_year_by_customers(year))
+    return {
+        'year': year,
+        'rows': {'by_sales_rep': len(by_sales_rep), 'by_customers': len(by_customers)},
+        'live_by_sales_rep': measure(lambda: list(Order.get_dispatched_order_in_year_by_sales_rep(year)), options['repeat']),
+        'live_by_customers': measure(lambda: list(Order.get_dispatched_order_in_year_by_customers(year)), options['repeat']),
+        'get_formatted_report_by_customers': measure(lambda: get_formatted_report(by_customers), options['repeat']),
+        'rollup_by_sales_rep': measure(
+            lambda: list(MonthlySalesRollup.get_sales_in_year_by_sales_rep(year)), options['repeat'],
+        ),
+        'rollup_by_customers': measure(
+            lambda: list(MonthlySalesRollup.get_sales_in_year_by_customers(year)), options['repeat'],
+        ),
+    }
+
+
+@benchmark('sales_view')
+def bench_sales_view(options):
+    """The sales report page, served from its stored snapshot, and storing the snapshot."""
+    with superuser_client() as client:
+        start = time.perf_counter()
+        store_sales_report(config.YEAR)
+        return {
+            'year': config.YEAR,
+            'store_sales_report': time.perf_counter() - start,
+            'get': measure_get(client, reverse('sales'), options['repeat']),
+        }
+
+
+@benchmark('order_admin')
+def bench_order_admin(options):
+    """The order changelist, its first and a deep page, and the order add form."""
+    changelist_url = reverse('admin:core_order_changelist')
+    with superuser_client() as client:
+        results = {
+            'changelist': measure_get(client, changelist_url, options['repeat']),
+            'changelist_dispatched': measure_get(client, f'{changelist_url}?status={Order.DISPATCHED}', options['repeat']),
+            'add_view': measure_get(client, reverse('admin:core_order_add'), options['repeat']),
+        }
+        # Paging forwards the way a user does, so the deep page can seek from the page before it
+        for page in range(1, 51):
+            client.get(f'{changelist_url}?p={page}')
+        results['changelist_page_50'] = measure_get(client, f'{changelist_url}?p=50', options['repeat'])
+    return results
+
+
+@benchmark('email_locmem')
+def bench_email_locmem(options):
+    """Rendering and building order created emails, handed to the locmem backend so no network is involved."""
+    context = get_order_email_context(5)
+    email_service = EmailService(ORDER_CREATED_EMAIL)
+
+    def send():
+        for i in range(options['messages']):
+            email_service.send([f'rep{i}@example.com'], [], **context)
+        mail.outbox = []
+
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        result = measure(send, options['repeat'])
+    return {
+        'messages': options['messages'],
+        **result,
+        'messages_per_second': options['messages'] / result['median'],
+    }
+
+
+@benchmark('db_connections')
+def bench_db_connections(options):
+    """
+    Requests running one query, going through Django's request signals, with a new connection each
+    and with a persistent one, with and without the health check.
+    """
+    requests = options['requests']
+    conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+
+    def serve_requests():
+        for _ in range(requests):
+            request_started.send(sender=None)
+            Order.objects.exists()
+            request_finished.send(sender=None)
+
+    results = {'requests': requests}
+    try:
+        for name, max_age, health_checks in [
+            ('per_request', 0, False),
+            ('persistent', 60, False),
+            ('persistent_health_checked', 60, True),
+        ]:
+            connection.close()
+            # Read when connecting, so it applies from the next connection on
+            connection.settings_dict['CONN_MAX_AGE'] = max_age
+            with override_settings(DATABASE_HEALTH_CHECKS=health_checks):
+                results[name] = measure(serve_requests, options['repeat'])
+    finally:
+        connection.close()
+        connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+    results['connect_ms_per_request'] = (
+        (results['per_request']['median'] - results['persistent']['median']) / requests * 1000
+    )
+    results['health_check_ms_per_request'] = (
+        (results['persistent_health_checked']['median'] - results['persistent']['median']) / requests * 1000
+    )
+    return results
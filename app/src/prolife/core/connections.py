@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.dispatch import receiver
+
+
+def close_unhealthy_connections():
+    """
+    Close the persistent database connections that no longer answer, e.g. after a database restart.
+
+    Django 2.2 only notices a dropped connection when a query fails on it, so without this check the
+    first request or task of every process after a restart would fail. A closed connection is
+    reopened by the next query. Connections in a transaction are left alone.
+    """
+    if not settings.DATABASE_HEALTH_CHECKS:
+        return
+    for connection in connections.all():
+        if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
+
+
+@receiver(request_started)
+def check_connections_on_request(**kwargs):
+    # Runs after Django's own receiver closed the connections older than CONN_MAX_AGE
+    close_unhealthy_connections()
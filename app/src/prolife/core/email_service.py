@@ -1,8 +1,16 @@
 import logging
+import re
+import threading
+import time
 from collections import defaultdict
+from functools import lru_cache
+from string import Formatter
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import Context
+from django.template.loader import get_template
+
+from prolife.core.metrics import timer
 
 logger = logging.getLogger(__name__)
 
@@ -19,28 +27,121 @@ ORDER_CREATED_EMAIL = {
 }
 
 
+EMAIL_CONFIGS = [WELCOME_EMAIL, ORDER_CREATED_EMAIL]
+
+# Compiled (plain text, html) templates per template name, loaded once per process
+_email_templates = {}
+
+
+class CompiledFormat:
+    """A `str.format` template parsed once, formatted with only the fields it uses; missing fields are blank."""
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = {
+            re.split(r'[.\[]', field_name, 1)[0]
+            for _, field_name, _, _ in Formatter().parse(text)
+            if field_name
+        }
+
+    def format(self, kwargs):
+        return self.text.format_map(defaultdict(str, {
+            field: kwargs[field] for field in self.fields if field in kwargs
+        }))
+
+
+@lru_cache(maxsize=None)
+def compile_format(text):
+    return CompiledFormat(text)
+
+
+def get_email_templates(template_name):
+    templates = _email_templates.get(template_name)
+    if templates is None:
+        templates = _email_templates[template_name] = (
+            get_template(f'core/email/{template_name}.txt').template,
+            get_template(f'core/email/{template_name}.html').template,
+        )
+    return templates
+
+
+def warm_email_templates():
+    """Compile every email's subject and templates, so the first send in a worker doesn't pay for it."""
+    for email_config in EMAIL_CONFIGS:
+        compile_format(email_config['subject'])
+        compile_format(email_config['message'])
+        if email_config['template_name'] is not None:
+            get_email_templates(email_config['template_name'])
+
+
 class EmailService:
     def __init__(self, email_config):
         self.email_config = email_config
 
     def format_text(self, text, **kwargs):
-        format_kwargs = defaultdict(str, kwargs)
-        return text.format_map(format_kwargs)
+        return compile_format(text).format(kwargs)
 
-    def send(self, to_emails, cc_emails, from_email=None, **kwargs):
-        if not to_emails:
-            logger.info("Not sending email because no destination emails.")
-            return
+    def render(self, **kwargs):
+        """Return the subject, plain text and html (or None) bodies for the given context."""
         subject = self.format_text(self.email_config['subject'], **kwargs)
         template_name = self.email_config['template_name']
         if template_name is None:
-            msg_plain = self.format_text(self.email_config['message'], **kwargs)
-            msg_html = None
-        else:
-            msg_plain = render_to_string(f'core/email/{template_name}.txt', context=kwargs)
-            msg_html = render_to_string(f'core/email/{template_name}.html', context=kwargs)
+            return subject, self.format_text(self.email_config['message'], **kwargs), None
+        plain_template, html_template = get_email_templates(template_name)
+        # Both bodies render from the same context, flattened once
+        context = Context(kwargs)
+        return subject, plain_template.render(context), html_template.render(context)
+
+    def build_message(self, to_emails, cc_emails, from_email=None, **kwargs):
+        subject, msg_plain, msg_html = self.render(**kwargs)
         from_email = from_email or settings.DEFAULT_FROM_EMAIL
-        logger.info("Sending email...")
         msg = EmailMultiAlternatives(subject, msg_plain, from_email, to=to_emails, cc=cc_emails or [])
-        msg.attach_alternative(msg_html, "text/html")
-        msg.send()
\ No newline at end of file
+        if msg_html is not None:
+            msg.attach_alternative(msg_html, "text/html")
+        return msg
+
+    def send(self, to_emails, cc_emails, from_email=None, connection=None, **kwargs):
+        if not to_emails:
+            logger.info("Not sending email because no destination emails.")
+            return
+        template_name = self.email_config['template_name']
+        with timer('email_render_seconds', template=template_name):
+            msg = self.build_message(to_emails, cc_emails, from_email=from_email, **kwargs)
+        logger.info("Sending email...")
+        msg.connection = connection
+        with timer('email_smtp_seconds', template=template_name):
+            msg.send()
+
+
+# The pooled mail connection of each thread, SMTP connections can't be shared between threads
+_local = threading.local()
+
+
+def get_pooled_connection():
+    """
+    Return this thread's persistent mail connection, opening it if needed.
+
+    The SMTP handshake, TLS negotiation and login are paid once per worker process or thread instead
+    of once per message. A connection idle for longer than EMAIL_CONNECTION_MAX_IDLE is reopened,
+    since servers drop idle clients.
+    """
+    now = time.monotonic()
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and now - _local.used_at > settings.EMAIL_CONNECTION_MAX_IDLE:
+        close_pooled_connection()
+        connection = None
+    if connection is None:
+        connection = get_connection()
+        connection.open()
+        _local.connection = connection
+    _local.used_at = now
+    return connection
+
+
+def close_pooled_connection():
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        try:
+            connection.close()
+        finally:
+            _local.connection = None
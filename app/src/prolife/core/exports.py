@@ -0,0 +1,58 @@
+import csv
+
+from django.http import StreamingHttpResponse
+
+from prolife.core.models import OrderedProduct
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_CHUNK_SIZE = 2000
+
+ORDER_LINE_COLUMNS = (
+    ('Order ID', 'order_id'),
+    ('Created at', 'order__created_at'),
+    ('Status', 'order__status'),
+    ('Sales rep', 'order__sales_rep__email'),
+    ('Customer', 'order__customer__name'),
+    ('Customer email', 'order__customer__email'),
+    ('County', 'order__customer__county'),
+    ('Postcode', 'order__customer__postcode'),
+    ('SKU', 'product__sku'),
+    ('Product', 'product__name'),
+    ('Quantity', 'quantity'),
+    ('Unit price', 'unit_price'),
+    ('Line total', 'line_total'),
+)
+
+
+class Echo:
+    """File-like object that hands back what the csv writer writes instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def csv_response(filename, header, rows):
+    """Stream `rows` as a CSV attachment without building the file in memory."""
+    response = StreamingHttpResponse(stream_csv(header, rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def get_order_lines(orders):
+    """Order line export rows for the `orders` queryset, read through a server-side cursor."""
+    return OrderedProduct.objects.filter(
+        order__in=orders,
+    ).values_list(
+        *(path for _, path in ORDER_LINE_COLUMNS)
+    ).order_by('order_id', 'id').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def order_lines_csv_response(orders, filename='order-lines.csv'):
+    return csv_response(filename, [title for title, _ in ORDER_LINE_COLUMNS], get_order_lines(orders))
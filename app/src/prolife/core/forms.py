@@ -0,0 +1,18 @@
+import os
+
+from django.forms import BooleanField, FileField, Form, ValidationError
+
+from prolife.core.imports import IMPORT_COLUMNS, IMPORT_FORMATS
+
+
+class OrderImportForm(Form):
+    file = FileField(help_text=f'CSV or JSON file of order lines with columns {", ".join(IMPORT_COLUMNS)}.')
+    notify = BooleanField(required=False, initial=True, help_text='Email the customers about their new orders.')
+    dry_run = BooleanField(required=False, help_text='Only check the file, without importing anything.')
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        self.cleaned_data['format'] = os.path.splitext(file.name)[1].lstrip('.').lower()
+        if self.cleaned_data['format'] not in IMPORT_FORMATS:
+            raise ValidationError(f'Upload a file with one of the extensions {", ".join(IMPORT_FORMATS)}.')
+        return file
@@ -0,0 +1,244 @@
+import csv
+import datetime as dt
+import json
+from itertools import groupby
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from prolife.core.models import Customer, MonthlySalesRollup, Order, OrderedProduct, OutboxMessage, Product
+from prolife.core.reports import invalidate_sales_report
+
+IMPORT_FORMATS = ('csv', 'json')
+# One row per order line, the order columns are read from the first line of each order
+IMPORT_COLUMNS = (
+    'order_ref',
+    'customer_email',
+    'product_sku',
+    'quantity',
+    'sales_rep_email',
+    'status',
+    'notes',
+    'created_at',
+)
+REQUIRED_COLUMNS = ('order_ref', 'customer_email', 'product_sku', 'quantity')
+# Orders inserted per transaction
+IMPORT_BATCH_SIZE = 1000
+STATUSES = {status for status, _ in Order.STATUS_CHOICES}
+
+
+class OrderImportError(Exception):
+    """The import file can't be read at all, as opposed to errors in some of its rows."""
+
+
+def read_rows(lines, format):
+    """
+    Yield (line number, row) for the order lines in `lines`, an iterable of text lines.
+
+    CSV is read as it streams in, a JSON array of row objects has to be parsed as a whole.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        missing = set(REQUIRED_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            raise OrderImportError(f'Missing column(s) {", ".join(sorted(missing))}')
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'json':
+        try:
+            rows = json.loads(''.join(lines))
+        except ValueError as e:
+            raise OrderImportError(f'Invalid JSON: {e}')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise OrderImportError('Expected a JSON array of order line objects')
+        for index, row in enumerate(rows, 1):
+            yield index, {column: '' if value is None else str(value) for column, value in row.items()}
+    else:
+        raise OrderImportError(f'Unknown format {format!r}, expected one of {", ".join(IMPORT_FORMATS)}')
+
+
+def parse_created_at(value):
+    created_at = parse_datetime(value)
+    if created_at is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid created_at {value!r}')
+        created_at = dt.datetime.combine(date, dt.time())
+    if timezone.is_naive(created_at):
+        created_at = timezone.make_aware(created_at)
+    return created_at
+
+
+class OrderImporter:
+    """
+    Create orders from rows of order lines, `batch_size` orders per transaction.
+
+    Lines with the same `order_ref` make up an order and must follow each other. Customers, products
+    and sales reps are looked up in bulk for each batch and remembered for the following ones,
+    customers and sales reps by their email in any case.
+    An order with an invalid line is skipped as a whole and reported in `errors` as
+    (line number, message); the other orders are imported.
+    """
+
+    def __init__(self, default_sales_rep=None, batch_size=IMPORT_BATCH_SIZE, notify=True, dry_run=False):
+        self.default_sales_rep = default_sales_rep
+        self.batch_size = batch_size
+        self.notify = notify
+        self.dry_run = dry_run
+        self.customers = {}
+        self.products = {}
+        self.sales_reps = {}
+        self.orders = 0
+        self.lines = 0
+        self.errors = []
+
+    def run(self, rows):
+        seen = set()
+        batch = []
+        for order_ref, lines in groupby(rows, key=lambda line: line[1].get('order_ref', '').strip()):
+            lines = list(lines)
+            if not order_ref:
+                self.errors.extend((line_number, 'Missing order_ref') for line_number, _ in lines)
+                continue
+            if order_ref in seen:
+                self.errors.append((lines[0][0], f'Lines of order {order_ref} must follow each other'))
+                continue
+            seen.add(order_ref)
+            batch.append((order_ref, lines))
+            if len(batch) == self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+        if self.orders and not self.dry_run:
+            invalidate_sales_report()
+        return self
+
+    def resolve(self, batch):
+        """Add the customers, products and sales reps of `batch` missing from the lookup maps."""
+        emails, skus, sales_rep_emails = set(), set(), set()
+        for _, lines in batch:
+            for _, row in lines:
+                emails.add(row.get('customer_email', '').strip().lower())
+                skus.add(row.get('product_sku', '').strip())
+                sales_rep_emails.add((row.get('sales_rep_email') or '').strip().lower())
+        emails -= set(self.customers)
+        skus -= set(self.products)
+        sales_rep_emails -= set(self.sales_reps) | {''}
+        self.customers.update(dict.fromkeys(emails))
+        self.customers.update(Customer.objects.filter(email_normalized__in=emails).values_list('email_normalized', 'pk'))
+        self.products.update(dict.fromkeys(skus))
+        self.products.update(
+            (sku, (pk, price)) for pk, sku, price in Product.objects.filter(sku__in=skus).values_list('pk', 'sku', 'price')
+        )
+        self.sales_reps.update(dict.fromkeys(sales_rep_emails))
+        users = User.objects.annotate(email_lower=Lower('email')).filter(email_lower__in=sales_rep_emails)
+        for email, pk in users.values_list('email_lower', 'pk'):
+            # Emails aren't unique among users, an ambiguous one can't be imported
+            self.sales_reps[email] = pk if self.sales_reps[email] is None else False
+
+    def build_order(self, order_ref, lines):
+        """Return the unsaved order with its lines and creation date, or None after reporting its errors."""
+        errors = []
+        first_line_number, first = lines[0]
+
+        customer_email = first.get('customer_email', '').strip()
+        customer_id = self.customers.get(customer_email.lower())
+        if customer_id is None:
+            errors.append((first_line_number, f'Unknown customer {customer_email!r}'))
+
+        sales_rep_email = (first.get('sales_rep_email') or '').strip()
+        if sales_rep_email:
+            sales_rep_id = self.sales_reps.get(sales_rep_email.lower())
+            if not sales_rep_id:
+                errors.append((first_line_number, f'Unknown or ambiguous sales rep {sales_rep_email!r}'))
+        elif self.default_sales_rep is not None:
+            sales_rep_id = self.default_sales_rep.pk
+        else:
+            errors.append((first_line_number, 'Missing sales_rep_email'))
+
+        status = (first.get('status') or Order.PROCESSING).strip()
+        if status not in STATUSES:
+            errors.append((first_line_number, f'Unknown status {status!r}'))
+
+        created_at = None
+        if first.get('created_at'):
+            try:
+                created_at = parse_created_at(first['created_at'].strip())
+            except ValueError as e:
+                errors.append((first_line_number, str(e)))
+
+        ordered_products = []
+        product_ids = set()
+        for line_number, row in lines:
+            sku = row.get('product_sku', '').strip()
+            product = self.products.get(sku)
+            if product is None:
+                errors.append((line_number, f'Unknown product {sku!r}'))
+                continue
+            product_id, price = product
+            if product_id in product_ids:
+                errors.append((line_number, f'Product {sku!r} is already on order {order_ref}'))
+                continue
+            product_ids.add(product_id)
+            try:
+                quantity = int(row.get('quantity', ''))
+            except ValueError:
+                quantity = 0
+            if quantity < 1:
+                errors.append((line_number, f'Invalid quantity {row.get("quantity")!r}'))
+                continue
+            ordered_products.append(OrderedProduct(
+                product_id=product_id,
+                quantity=quantity,
+                unit_price=price,
+                line_total=quantity * price,
+            ))
+
+        if errors:
+            self.errors.extend(errors)
+            return None
+        order = Order(
+            sales_rep_id=sales_rep_id,
+            customer_id=customer_id,
+            status=status,
+            notes=first.get('notes') or None,
+        )
+        return order, ordered_products, created_at
+
+    def import_batch(self, batch):
+        self.resolve(batch)
+        built = [self.build_order(order_ref, lines) for order_ref, lines in batch]
+        built = [order for order in built if order is not None]
+        if not built:
+            return
+        if not self.dry_run:
+            self.save(built)
+        self.orders += len(built)
+        self.lines += sum(len(ordered_products) for _, ordered_products, _ in built)
+
+    def save(self, built):
+        with transaction.atomic():
+            orders = Order.objects.bulk_create(order for order, _, _ in built)
+            # bulk_create() honours auto_now_add, so imported creation dates are written afterwards
+            dated = []
+            for order, _, created_at in built:
+                if created_at is not None:
+                    order.created_at = created_at
+                    dated.append(order)
+            if dated:
+                Order.objects.bulk_update(dated, ['created_at'])
+            lines = []
+            for order, ordered_products, _ in built:
+                for ordered_product in ordered_products:
+                    ordered_product.order_id = order.pk
+                    lines.append(ordered_product)
+            OrderedProduct.objects.bulk_create(lines)
+            MonthlySalesRollup.refresh(order.rollup_key for order in orders if order.status == Order.DISPATCHED)
+            if self.notify:
+                OutboxMessage.objects.bulk_create(
+                    OutboxMessage(event=OutboxMessage.ORDER_CREATED, payload={'order_id': order.pk}) for order in orders
+                )
@@ -0,0 +1,141 @@
+"""
+Concurrent load test of a running server with mixed admin traffic, run by `manage.py load_test`.
+
+Each client thread logs in as the same superuser and requests pages picked by weight from
+`TRAFFIC` until the time is up, reading every response to its end like a browser downloading an
+export would.
+"""
+import datetime as dt
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.urls import reverse
+from django.utils import timezone
+
+from prolife.core.models import Order
+
+# Name: weight of the pages requested, mostly changelists and autocompletes with a few reports and exports
+TRAFFIC = {
+    'order_changelist': 30,
+    'order_changelist_dispatched': 10,
+    'order_change': 20,
+    'product_autocomplete': 25,
+    'sales': 5,
+    'sales_breakdown': 5,
+    'order_lines_export': 5,
+}
+# Days of order lines in each export
+EXPORT_DAYS = 7
+
+
+def get_traffic_urls():
+    """Return {name: path} for the pages of `TRAFFIC`, on the data of the current database."""
+    last_order = Order.objects.order_by('-pk').first()
+    if last_order is None:
+        raise ValueError('The load test needs orders, e.g. from `manage.py generate_synthetic_data`.')
+    export_end = timezone.localdate(last_order.created_at)
+    changelist_url = reverse('admin:core_order_changelist')
+    return {
+        'order_changelist': changelist_url,
+        'order_changelist_dispatched': f'{changelist_url}?{urlencode({"status": Order.DISPATCHED})}',
+        'order_change': reverse('admin:core_order_change', args=[last_order.pk]),
+        'product_autocomplete': f'{reverse("admin:core_product_autocomplete")}?{urlencode({"term": "prod"})}',
+        'sales': reverse('sales'),
+        'sales_breakdown': f'{reverse("sales_breakdown")}?{urlencode({"granularity": "quarter", "group_by": "county"})}',
+        'order_lines_export': f'{reverse("order_lines_export")}?' + urlencode({
+            'start': export_end - dt.timedelta(days=EXPORT_DAYS - 1),
+            'end': export_end,
+        }),
+    }
+
+
+@contextmanager
+def superuser_session(user):
+    """Yield a session cookie logged in as `user`, deleting the session when the block exits."""
+    session = SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    try:
+        yield f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+    finally:
+        session.delete()
+
+
+def percentile(timings, share):
+    return timings[min(int(len(timings) * share), len(timings) - 1)]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'median': statistics.median(timings),
+        'p95': percentile(timings, 0.95),
+        'max': timings[-1],
+    } if timings else {}
+
+
+def run_load_test(base_url, urls, cookie, concurrency, duration, timeout=60, seed=0):
+    """
+    Request `urls` from `concurrency` threads for `duration` seconds.
+
+    Returns the throughput and the latency of every page; responses other than 200 and failed
+    requests count as errors and aren't part of the latencies.
+    """
+    names = list(urls)
+    weights = [TRAFFIC[name] for name in names]
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(rng):
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            request = urllib.request.Request(base_url + urls[name], headers={'Cookie': cookie})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    while response.read(64 * 1024):
+                        pass
+                    # A lost session redirects to the login page
+                    ok = response.status == 200 and response.geturl() == request.full_url
+            except (urllib.error.URLError, OSError):
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    timings[name].append(elapsed)
+                else:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=client, args=(random.Random(seed + i),)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    completed = sum(map(len, timings.values()))
+    return {
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'requests': completed,
+        'errors': sum(errors.values()),
+        'requests_per_second': completed / elapsed,
+        'latency': summarize([timing for page_timings in timings.values() for timing in page_timings]),
+        'pages': {
+            name: {'requests': len(timings[name]), 'errors': errors[name], **summarize(timings[name])}
+            for name in names
+        },
+    }
@@ -0,0 +1,95 @@
+import json
+import os
+import platform
+import subprocess
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from prolife.core.benchmarks import BENCHMARKS
+from prolife.core.models import Customer, Order, OrderedProduct, Product
+
+
+def get_commit():
+    """Return the checked out git commit, or GIT_COMMIT where the source isn't a git checkout, e.g. in the image."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.environ.get('GIT_COMMIT')
+
+
+def get_medians(results, path=()):
+    """Yield (path, median) for every measurement in `results`."""
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if 'median' in value:
+                yield '.'.join(path + (key,)), value['median']
+            else:
+                yield from get_medians(value, path + (key,))
+
+
+class Command(BaseCommand):
+    help = 'Run the registered benchmarks and print (or save) the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Benchmarks to run (default: all of {", ".join(BENCHMARKS)}).')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement.')
+        parser.add_argument('--rows', type=int, default=100000, help='Input size for the report benchmarks.')
+        parser.add_argument('--customers', type=int, default=1000000, help='Customers seeded for the search benchmarks.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests served by the connection benchmark.')
+        parser.add_argument('--messages', type=int, default=100, help='Emails sent by the email benchmarks.')
+        parser.add_argument(
+            '--smtp-latency',
+            type=float,
+            default=0.02,
+            help='Seconds the local SMTP stand-in waits before greeting, standing in for TLS and login.',
+        )
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Compare the medians with the results in this JSON file, e.g. of the previous commit.')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Unknown benchmark(s): {", ".join(sorted(unknown))}')
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = dict(get_medians(json.load(f)['results']))
+
+        results = {}
+        for name in names:
+            self.stderr.write(f'Running {name}...')
+            results[name] = BENCHMARKS[name](options)
+
+        output = json.dumps({
+            'meta': {
+                'commit': get_commit(),
+                'run_at': timezone.now(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'options': {name: options[name] for name in ('repeat', 'rows', 'customers', 'messages', 'smtp_latency')},
+                # Timings only compare between runs over the same data
+                'rows': {
+                    model._meta.label: model.objects.count() for model in (Customer, Product, Order, OrderedProduct)
+                },
+            },
+            'results': results,
+        }, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if baseline is not None:
+            for path, median in get_medians(results):
+                if path in baseline:
+                    self.stderr.write(f'{path}: {baseline[path]:.4f}s -> {median:.4f}s ({median / baseline[path] - 1:+.0%})')
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from prolife.core.synthetic import generate_synthetic_data
+
+
+class Command(BaseCommand):
+    help = (
+        'Add synthetic customers, products, sales reps and orders with their lines spread over several years, '
+        'for benchmarks and load tests. Never run it against production.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=10000, help='Customers to add.')
+        parser.add_argument('--products', type=int, default=2000, help='Products to add.')
+        parser.add_argument('--sales-reps', type=int, default=20, help='Sales reps to add, the new orders are theirs.')
+        parser.add_argument('--orders', type=int, default=200000, help='Orders to add.')
+        parser.add_argument('--years', type=int, default=5, help='Years back the orders are spread over.')
+        parser.add_argument('--lines-per-order', type=int, default=5, help='Maximum lines of an order.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random sequence.')
+
+    def handle(self, *args, **options):
+        if options['orders'] and options['sales_reps'] < 1:
+            raise CommandError('Orders need at least one new sales rep.')
+        if min(options['years'], options['lines_per_order']) < 1:
+            raise CommandError('--years and --lines-per-order must be positive.')
+        start = time.perf_counter()
+        generate_synthetic_data(
+            customers=options['customers'],
+            products=options['products'],
+            sales_reps=options['sales_reps'],
+            orders=options['orders'],
+            years=options['years'],
+            lines_per_order=options['lines_per_order'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Added {options["customers"]} customers, {options["products"]} products, {options["sales_reps"]} sales reps '
+            f'and {options["orders"]} orders in {time.perf_counter() - start:.1f}s.'
+        ))
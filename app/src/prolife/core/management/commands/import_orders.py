@@ -0,0 +1,48 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from prolife.core.imports import IMPORT_BATCH_SIZE, IMPORT_COLUMNS, IMPORT_FORMATS, OrderImporter, OrderImportError, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Import orders from a CSV file or JSON array with one row per order line and the columns '
+        f'{", ".join(IMPORT_COLUMNS)}.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import.')
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help='File format (default: from the file extension).')
+        parser.add_argument('--sales-rep', help='Email of the sales rep of orders without a sales_rep_email.')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Orders inserted per transaction.')
+        parser.add_argument('--no-notify', action='store_true', help="Don't send order created emails.")
+        parser.add_argument('--dry-run', action='store_true', help='Only validate the file.')
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        default_sales_rep = None
+        if options['sales_rep']:
+            default_sales_rep = User.objects.filter(email=options['sales_rep']).first()
+            if default_sales_rep is None:
+                raise CommandError(f'No user with the email {options["sales_rep"]}')
+
+        importer = OrderImporter(
+            default_sales_rep=default_sales_rep,
+            batch_size=options['batch_size'],
+            notify=not options['no_notify'],
+            dry_run=options['dry_run'],
+        )
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                importer.run(read_rows(f, format))
+        except (OSError, OrderImportError) as e:
+            raise CommandError(str(e))
+
+        for line_number, message in importer.errors:
+            self.stderr.write(f'Line {line_number}: {message}')
+        verb = 'Validated' if options['dry_run'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {importer.orders} order(s) with {importer.lines} line(s), {len(importer.errors)} error(s).'
+        ))
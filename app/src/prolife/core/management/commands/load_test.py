@@ -0,0 +1,55 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from prolife.core.load_test import TRAFFIC, get_traffic_urls, run_load_test, superuser_session
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test a running server, e.g. gunicorn started with gunicorn.conf.py, with concurrent mixed admin '
+        'traffic and print the throughput and latencies as JSON. Run it against a copy of the data, never production.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the server.')
+        parser.add_argument('--concurrency', type=int, default=16, help='Clients requesting pages at the same time.')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run for.')
+        parser.add_argument('--username', help='Superuser to log in as (default: the first one).')
+        parser.add_argument(
+            '--pages',
+            nargs='+',
+            choices=list(TRAFFIC),
+            help='Only request these pages (default: all, by weight).',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the page choices.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(is_superuser=True, is_active=True).order_by('pk')
+        if options['username']:
+            users = users.filter(username=options['username'])
+        user = users.first()
+        if user is None:
+            raise CommandError('No such active superuser.')
+        try:
+            urls = get_traffic_urls()
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['pages']:
+            urls = {name: url for name, url in urls.items() if name in options['pages']}
+        with superuser_session(user) as cookie:
+            results = run_load_test(
+                options['url'].rstrip('/'),
+                urls,
+                cookie,
+                concurrency=options['concurrency'],
+                duration=options['duration'],
+                seed=options['seed'],
+            )
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from prolife.core.models import MonthlySalesRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the monthly sales rollup from scratch and verify it against the live order aggregation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check-only',
+            action='store_true',
+            help='Only compare the stored rollup with the live aggregation, without rebuilding it.',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check_only']:
+            MonthlySalesRollup.rebuild()
+            self.stdout.write('Rollup rebuilt.')
+
+        live = MonthlySalesRollup.get_live_totals()
+        stored = {rollup.key: rollup.amount for rollup in MonthlySalesRollup.objects.all()}
+        mismatches = [
+            (key, stored.get(key), live.get(key))
+            for key in sorted(set(live) | set(stored))
+            if stored.get(key) != live.get(key)
+        ]
+        for (year, month, sales_rep_id, customer_id), stored_amount, live_amount in mismatches:
+            self.stderr.write(
+                f'{year}-{month:02d} sales rep {sales_rep_id}, customer {customer_id}: '
+                f'rollup {stored_amount}, live {live_amount}'
+            )
+        if mismatches:
+            raise CommandError(f'{len(mismatches)} rollup bucket(s) differ from the live aggregation.')
+        self.stdout.write(self.style.SUCCESS(f'{len(stored)} rollup bucket(s) match the live aggregation.'))
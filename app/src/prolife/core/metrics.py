@@ -0,0 +1,188 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+from prolife.utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = 'metrics'
+# Upper bounds in seconds, from template renders to SMTP sends stuck until EMAIL_TIMEOUT
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+
+# Name: (type, help) of every metric, in the order they are exposed
+METRICS = {
+    'celery_task_queue_seconds': ('histogram', 'Time from publishing a task, or its ETA, until a worker started it.'),
+    'celery_task_run_seconds': ('histogram', 'Time a worker spent running a task.'),
+    'celery_task_retries_total': ('counter', 'Task retries.'),
+    'celery_task_failures_total': ('counter', 'Tasks that raised an exception.'),
+    'email_render_seconds': ('histogram', 'Time spent rendering an email.'),
+    'email_smtp_seconds': ('histogram', 'Time spent handing an email over to the SMTP server.'),
+}
+# Seconds observations are dropped without trying the metrics Redis once it failed
+REDIS_RETRY_DELAY = 30
+
+# Monotonic time until which this process drops observations after the metrics Redis failed
+_redis_unavailable_until = 0.0
+
+
+def get_redis_with_timeouts(url):
+    # An unreachable Redis fails in METRICS_REDIS_TIMEOUT instead of holding up what is measured
+    return get_redis(
+        url,
+        socket_connect_timeout=settings.METRICS_REDIS_TIMEOUT,
+        socket_timeout=settings.METRICS_REDIS_TIMEOUT,
+    )
+
+
+def get_metrics_redis():
+    return get_redis_with_timeouts(settings.METRICS_REDIS_URL) if settings.METRICS_REDIS_URL else None
+
+
+def get_recording_redis():
+    """Return the metrics Redis to record to, or None while it's skipped after failing."""
+    if time.monotonic() < _redis_unavailable_until:
+        return None
+    return get_metrics_redis()
+
+
+def drop_recording(action, name):
+    global _redis_unavailable_until
+    _redis_unavailable_until = time.monotonic() + REDIS_RETRY_DELAY
+    logger.warning(
+        "Dropped %s of %s, the metrics Redis is unavailable, skipping it for %s seconds.",
+        action, name, REDIS_RETRY_DELAY, exc_info=True,
+    )
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def format_sample(name, labels, value):
+    return f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+
+def format_bound(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+def observe(name, value, **labels):
+    """
+    Add `value` to histogram `name`, shared by all processes through Redis.
+
+    Metrics never fail the code they measure: without a metrics Redis, or when it's down, the
+    observation is dropped. After a failure the Redis isn't tried for REDIS_RETRY_DELAY seconds, so
+    an unreachable one costs a single timeout.
+    """
+    client = get_recording_redis()
+    if client is None:
+        return
+    bound = next(bound for bound in HISTOGRAM_BUCKETS if value <= bound)
+    series = format_labels(labels)
+    key = f'{METRICS_KEY_PREFIX}:{name}'
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hincrby(key, f'{series}|{format_bound(bound)}', 1)
+        pipe.hincrbyfloat(key, f'{series}|sum', value)
+        pipe.execute()
+    except redis.RedisError:
+        drop_recording('an observation', name)
+
+
+def increment(name, **labels):
+    """Increment counter `name`, like `observe()` a no-op without a metrics Redis."""
+    client = get_recording_redis()
+    if client is None:
+        return
+    try:
+        client.hincrby(f'{METRICS_KEY_PREFIX}:{name}', format_labels(labels), 1)
+    except redis.RedisError:
+        drop_recording('an increment', name)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of the block in histogram `name`, whether it raises or not."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def get_histogram_lines(name, values):
+    """Expose the per-bucket counts stored for histogram `name` as cumulative Prometheus buckets."""
+    series = {}
+    for field, value in values.items():
+        labels, bound = field.rsplit('|', 1)
+        series.setdefault(labels, {})[bound] = float(value) if bound == 'sum' else int(value)
+    for labels, counts in sorted(series.items()):
+        cumulative = 0
+        for bound in map(format_bound, HISTOGRAM_BUCKETS):
+            cumulative += counts.get(bound, 0)
+            yield format_sample(f'{name}_bucket', ','.join(filter(None, [labels, f'le="{bound}"'])), cumulative)
+        yield format_sample(f'{name}_sum', labels, counts.get('sum', 0.0))
+        yield format_sample(f'{name}_count', labels, cumulative)
+
+
+def get_queue_lengths():
+    """
+    Return {queue: waiting tasks} for the Celery queues, read from the Redis broker.
+
+    Empty when the broker isn't Redis or is down, so the scrape still returns the other metrics.
+    """
+    if not settings.CELERY_BROKER_URL.startswith('redis'):
+        return {}
+    client = get_redis_with_timeouts(settings.CELERY_BROKER_URL)
+    try:
+        pipe = client.pipeline(transaction=False)
+        for queue in settings.CELERY_TASK_QUEUES:
+            pipe.llen(queue.name)
+        lengths = pipe.execute()
+    except redis.RedisError:
+        logger.warning("Skipped the queue lengths, the broker Redis is unavailable.", exc_info=True)
+        return {}
+    return dict(zip((queue.name for queue in settings.CELERY_TASK_QUEUES), lengths))
+
+
+def render_metrics(extra_gauges=()):
+    """
+    Return all metrics in the Prometheus text format.
+
+    `extra_gauges` are (name, help, {labels string: value}) read at scrape time. When the metrics
+    Redis is down the stored metrics are left empty and `metrics_redis_up` reports 0.
+    """
+    lines = []
+    client = get_metrics_redis()
+    stored = {}
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            for name in METRICS:
+                pipe.hgetall(f'{METRICS_KEY_PREFIX}:{name}')
+            stored = {
+                name: {field.decode(): value.decode() for field, value in values.items()}
+                for name, values in zip(METRICS, pipe.execute())
+            }
+        except redis.RedisError:
+            logger.warning("Skipped the stored metrics, the metrics Redis is unavailable.", exc_info=True)
+            up = 0
+        else:
+            up = 1
+        extra_gauges = [('metrics_redis_up', 'Whether the metrics Redis could be read.', {'': up}), *extra_gauges]
+    for name, (type, help) in METRICS.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {type}']
+        values = stored.get(name, {})
+        if type == 'histogram':
+            lines += get_histogram_lines(name, values)
+        else:
+            lines += [format_sample(name, labels, value) for labels, value in sorted(values.items())]
+    for name, help, values in extra_gauges:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+        lines += [format_sample(name, labels, value) for labels, value in sorted(values.items())]
+    return '\n'.join(lines) + '\n'
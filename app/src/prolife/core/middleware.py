@@ -0,0 +1,40 @@
+import random
+import time
+
+from django.conf import settings
+
+from prolife.core.profiling import profile
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sample of the requests: wall time, SQL queries and template rendering.
+
+    PROFILING_SAMPLE_RATE of the requests are profiled; their timings are logged as JSON by
+    `prolife.core.profiling` and returned in a Server-Timing header, which the browser's developer
+    tools show next to the request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+        with profile('request', method=request.method, path=request.path) as request.profile:
+            response = self.get_response(request)
+            resolver_match = getattr(request, 'resolver_match', None)
+            request.profile.extra.update(
+                view=resolver_match.view_name if resolver_match else None,
+                status=response.status_code,
+            )
+        response['Server-Timing'] = request.profile.get_server_timing()
+        return response
+
+    def process_template_response(self, request, response):
+        """Time the rendering of template responses, e.g. of the admin views, which happens after the view returned."""
+        current = getattr(request, 'profile', None)
+        if current is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda response: current.add_span('render', time.perf_counter() - start))
+        return response
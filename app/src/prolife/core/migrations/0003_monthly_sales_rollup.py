@@ -0,0 +1,65 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:56
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+import django.db.models.deletion
+
+
+def populate_rollup(apps, schema_editor):
+    OrderedProduct = apps.get_model('core', 'OrderedProduct')
+    MonthlySalesRollup = apps.get_model('core', 'MonthlySalesRollup')
+    totals = OrderedProduct.objects.filter(
+        order__status='dispatched',
+    ).annotate(
+        year=ExtractYear('order__created_at'),
+        month=ExtractMonth('order__created_at'),
+    ).values(
+        'year',
+        'month',
+        'order__sales_rep',
+        'order__customer',
+    ).annotate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('product__price'), output_field=DecimalField())),
+    ).order_by()
+    MonthlySalesRollup.objects.bulk_create(
+        (
+            MonthlySalesRollup(
+                year=row['year'],
+                month=row['month'],
+                sales_rep_id=row['order__sales_rep'],
+                customer_id=row['order__customer'],
+                amount=row['total'],
+            )
+            for row in totals
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0002_order_created_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySalesRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Customer')),
+                ('sales_rep', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('year', 'month', 'sales_rep', 'customer')},
+            },
+        ),
+        migrations.RunPython(populate_rollup, migrations.RunPython.noop),
+    ]
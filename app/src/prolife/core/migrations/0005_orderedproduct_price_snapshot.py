@@ -0,0 +1,34 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:05
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def backfill_price_snapshot(apps, schema_editor):
+    Product = apps.get_model('core', 'Product')
+    OrderedProduct = apps.get_model('core', 'OrderedProduct')
+    OrderedProduct.objects.update(
+        unit_price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1]),
+    )
+    OrderedProduct.objects.update(line_total=F('quantity') * F('unit_price'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_order_report_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderedproduct',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderedproduct',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=14, null=True),
+        ),
+        migrations.RunPython(backfill_price_snapshot, migrations.RunPython.noop),
+    ]
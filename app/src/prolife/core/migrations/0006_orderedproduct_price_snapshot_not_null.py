@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_orderedproduct_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderedproduct',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='orderedproduct',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=14),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_orderedproduct_price_snapshot_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesReportSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(unique=True)),
+                ('html', models.TextField()),
+                ('generated_at', models.DateTimeField()),
+            ],
+        ),
+    ]
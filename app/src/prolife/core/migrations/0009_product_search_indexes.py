@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:40
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_outbox_message'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # icontains and istartswith compare UPPER(column), index the same expression so the admin search can use it
+        migrations.RunSQL(
+            'CREATE INDEX core_product_name_trgm ON core_product USING gin (UPPER(name) gin_trgm_ops)',
+            'DROP INDEX core_product_name_trgm',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX core_product_sku_trgm ON core_product USING gin (UPPER(sku) gin_trgm_ops)',
+            'DROP INDEX core_product_sku_trgm',
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 2.2.10 on 2026-10-18 14:05
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+from prolife.utils import normalize_phone_number
+
+BATCH_SIZE = 2000
+
+
+def populate_search_keys(apps, schema_editor):
+    Customer = apps.get_model('core', 'Customer')
+    batch = []
+    for customer in Customer.objects.only('email', 'phone_number', 'mobile').iterator(chunk_size=BATCH_SIZE):
+        customer.email_normalized = customer.email.strip().lower()
+        customer.phone_digits = normalize_phone_number(customer.phone_number)
+        customer.mobile_digits = normalize_phone_number(customer.mobile) if customer.mobile else None
+        batch.append(customer)
+        if len(batch) == BATCH_SIZE:
+            Customer.objects.bulk_update(batch, ['email_normalized', 'phone_digits', 'mobile_digits'])
+            batch = []
+    Customer.objects.bulk_update(batch, ['email_normalized', 'phone_digits', 'mobile_digits'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_product_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='email_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=254),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='phone_digits',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=16),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='mobile_digits',
+            field=models.CharField(db_index=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(populate_search_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='customer',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['email_normalized'],
+                name='core_customer_email_trgm',
+                opclasses=['gin_trgm_ops'],
+            ),
+        ),
+        # On UPPER(name), like the product indexes of 0009_product_search_indexes
+        migrations.RunSQL(
+            'CREATE INDEX core_customer_name_trgm ON core_customer USING gin (UPPER(name) gin_trgm_ops)',
+            'DROP INDEX core_customer_name_trgm',
+        ),
+        # Serves the istartswith of words too short for trigrams
+        migrations.RunSQL(
+            'CREATE INDEX core_customer_name_prefix ON core_customer (UPPER(name) text_pattern_ops)',
+            'DROP INDEX core_customer_name_prefix',
+        ),
+    ]
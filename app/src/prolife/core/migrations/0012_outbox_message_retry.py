@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_order_changelist_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
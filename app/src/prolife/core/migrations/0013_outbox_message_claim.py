@@ -0,0 +1,34 @@
+# Generated by Django 2.2.10 on 2026-10-18 16:05
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_relayed_messages_delivered(apps, schema_editor):
+    # Messages now stay pending until delivered, the ones relayed before were handed over for good
+    OutboxMessage = apps.get_model('core', 'OutboxMessage')
+    OutboxMessage.objects.filter(relayed_at__isnull=False, delivered_at__isnull=True).update(delivered_at=F('relayed_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_outbox_message_retry'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboxmessage',
+            name='core_outbox_pending',
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(mark_relayed_messages_delivered, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(delivered_at__isnull=True), fields=['id'], name='core_outbox_pending'),
+        ),
+    ]
@@ -1,9 +1,19 @@
-from django.db import models
+import datetime as dt
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.db import connection, models, transaction
 from django.core.validators import RegexValidator, MinValueValidator
 from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.urls import reverse
-from django.db.models.functions import ExtractMonth
-from django.db.models import Sum, ExpressionWrapper, F, DecimalField
+from django.utils import timezone
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.models import Sum, Q
+
+from prolife.utils import get_month_range, get_year_range, normalize_phone_number
 
 class Product(models.Model):
     name = models.CharField(max_length=256, unique=True)
@@ -30,10 +40,29 @@ class Customer(models.Model):
     city = models.CharField(max_length=256)
     county = models.CharField(max_length=256)
     postcode = models.CharField(max_length=256)
+    # Search keys kept in sync by save(), looked up by prefix in the customer autocomplete
+    email_normalized = models.CharField(max_length=254, db_index=True, editable=False)
+    phone_digits = models.CharField(max_length=16, db_index=True, editable=False)
+    mobile_digits = models.CharField(max_length=16, db_index=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['email_normalized'], name='core_customer_email_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return f'{self.name}, {self.address}, {self.city}, {self.county} ({self.postcode})'
 
+    def save(self, *args, **kwargs):
+        self.set_search_keys()
+        super().save(*args, **kwargs)
+
+    def set_search_keys(self):
+        """Derive the search columns, call it before `bulk_create()` as that skips `save()`."""
+        self.email_normalized = self.email.strip().lower()
+        self.phone_digits = normalize_phone_number(self.phone_number)
+        self.mobile_digits = normalize_phone_number(self.mobile) if self.mobile else None
+
 
 class Order(models.Model):
     PROCESSING = 'processing'
@@ -45,6 +74,12 @@ class Order(models.Model):
         (AWAITING_CUSTOMER_RESPONSE, 'Awaiting customer response'),
         (DISPATCHED, 'Dispatched'),
     )
+    # Statuses an order can be moved to in bulk from each status, dispatched orders stay dispatched
+    ALLOWED_TRANSITIONS = {
+        PROCESSING: (AWAITING_CUSTOMER_RESPONSE, DISPATCHED),
+        AWAITING_CUSTOMER_RESPONSE: (PROCESSING, DISPATCHED),
+        DISPATCHED: (),
+    }
 
     sales_rep = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     notes = models.TextField(null=True, blank=True)
@@ -53,6 +88,31 @@ class Order(models.Model):
     products = models.ManyToManyField(Product, through='OrderedProduct')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='core_order_status_created'),
+            models.Index(fields=['created_at', 'id'], name='core_order_created_id'),
+            models.Index(fields=['sales_rep', 'created_at'], name='core_order_rep_created'),
+        ]
+
+    ROLLUP_FIELDS = ('status', 'created_at', 'sales_rep_id', 'customer_id')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields().intersection(cls.ROLLUP_FIELDS):
+            instance.remember_rollup_state()
+        return instance
+
+    def remember_rollup_state(self):
+        """Store the rollup bucket the order contributes to as loaded from the db."""
+        self._loaded_rollup_key = self.rollup_key if self.status == self.DISPATCHED else None
+
+    @property
+    def rollup_key(self):
+        created_at = timezone.localtime(self.created_at)
+        return created_at.year, created_at.month, self.sales_rep_id, self.customer_id
+
     @property
     def url(self):
         return settings.BASE_URL + reverse(
@@ -67,20 +127,17 @@ class Order(models.Model):
 
     @classmethod
     def get_dispatched_order_queryset_in_year_by_month(cls, year):
+        start, end = get_year_range(year)
         return cls.objects.prefetch_related('orderedproduct').filter(
-            created_at__year=year,
+            created_at__gte=start,
+            created_at__lt=end,
             status=cls.DISPATCHED,
         ).annotate(
             month=ExtractMonth('created_at'),
         ).values(
             'month',
         ).annotate(
-            amount=Sum(
-                ExpressionWrapper(
-                    F('orderedproduct__quantity') * F('orderedproduct__product__price'),
-                    output_field=DecimalField()
-                )
-            ),
+            amount=Sum('orderedproduct__line_total'),
         )
 
     @classmethod
@@ -104,9 +161,282 @@ class OrderedProduct(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+    # Snapshot of the product price when the line was saved, so price edits don't rewrite history
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
+    line_total = models.DecimalField(max_digits=14, decimal_places=2, editable=False)
 
     class Meta:
         unique_together = ['product', 'order']
 
     def __str__(self):
-        return f'Product: {self.product.name}, Order: {self.order.id}'
+        return f'Product: {self.product.name}, Order: {self.order_id}'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_product_id = instance.product_id
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.unit_price is None or self.product_id != getattr(self, '_snapshot_product_id', self.product_id):
+            self.unit_price = self.product.price
+        self.line_total = self.quantity * self.unit_price
+        super().save(*args, **kwargs)
+        self._snapshot_product_id = self.product_id
+
+
+class MonthlySalesRollup(models.Model):
+    """
+    Dispatched sales pre-summed by (year, month, sales rep, customer).
+
+    Rows are refreshed by the signal handlers in `prolife.core.signals` whenever an order or one of its
+    lines changes, and can be rebuilt from scratch with `manage.py rebuild_sales_rollup`.
+    """
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    sales_rep = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ['year', 'month', 'sales_rep', 'customer']
+
+    def __str__(self):
+        return f'{self.year}-{self.month:02d} {self.sales_rep_id}/{self.customer_id}: {self.amount}'
+
+    @property
+    def key(self):
+        return self.year, self.month, self.sales_rep_id, self.customer_id
+
+    @classmethod
+    def get_live_totals_queryset(cls, keys=None):
+        """
+        Dispatched order lines summed by year, month, sales rep and customer as a values queryset.
+
+        When `keys` is given the sums cover at least those buckets.
+        """
+        qs = OrderedProduct.objects.filter(order__status=Order.DISPATCHED)
+        if keys is not None:
+            bucket_filters = []
+            for year, month, sales_rep_ids, customer_ids in cls.group_keys_by_month(keys):
+                start, end = get_month_range(year, month)
+                bucket_filters.append(Q(
+                    order__created_at__gte=start,
+                    order__created_at__lt=end,
+                    order__sales_rep_id__in=sales_rep_ids,
+                    order__customer_id__in=customer_ids,
+                ))
+            qs = qs.filter(reduce(or_, bucket_filters))
+        return qs.annotate(
+            year=ExtractYear('order__created_at'),
+            month=ExtractMonth('order__created_at'),
+        ).values(
+            'year',
+            'month',
+            'order__sales_rep',
+            'order__customer',
+        ).annotate(
+            total=Sum('line_total'),
+        ).order_by()
+
+    @classmethod
+    def get_live_totals(cls, keys=None):
+        """
+        Aggregate dispatched order lines into {(year, month, sales_rep_id, customer_id): amount}.
+
+        When `keys` is given only those buckets are returned.
+        """
+        if keys is not None:
+            if not keys:
+                return {}
+            keys = set(keys)
+        totals = {
+            (int(row['year']), int(row['month']), row['order__sales_rep'], row['order__customer']): row['total']
+            for row in cls.get_live_totals_queryset(keys)
+        }
+        if keys is not None:
+            totals = {key: total for key, total in totals.items() if key in keys}
+        return totals
+
+    @staticmethod
+    def group_keys_by_month(keys):
+        """
+        Group bucket keys into [(year, month, sales_rep_ids, customer_ids)].
+
+        Filtering each month on its sets of sales reps and customers matches a superset of the buckets
+        with a handful of conditions, where a condition per bucket makes large refreshes slow to plan.
+        """
+        months = {}
+        for year, month, sales_rep_id, customer_id in keys:
+            sales_rep_ids, customer_ids = months.setdefault((year, month), (set(), set()))
+            sales_rep_ids.add(sales_rep_id)
+            customer_ids.add(customer_id)
+        return [
+            (year, month, sales_rep_ids, customer_ids)
+            for (year, month), (sales_rep_ids, customer_ids) in months.items()
+        ]
+
+    @classmethod
+    def get_keys_for_orders(cls, orders):
+        """Return the buckets the given order queryset contributes to."""
+        keys = orders.annotate(
+            year=ExtractYear('created_at'),
+            month=ExtractMonth('created_at'),
+        ).values_list('year', 'month', 'sales_rep_id', 'customer_id').order_by().distinct()
+        return {(int(year), int(month), sales_rep_id, customer_id) for year, month, sales_rep_id, customer_id in keys}
+
+    @classmethod
+    def refresh(cls, keys):
+        """Recompute the given buckets from the live order lines."""
+        keys = set(keys)
+        if not keys:
+            return
+        totals = cls.get_live_totals(keys)
+        with transaction.atomic():
+            existing = {
+                rollup.key: rollup for rollup in cls.objects.select_for_update().filter(
+                    reduce(or_, (
+                        Q(year=year, month=month, sales_rep_id__in=sales_rep_ids, customer_id__in=customer_ids)
+                        for year, month, sales_rep_ids, customer_ids in cls.group_keys_by_month(keys)
+                    ))
+                ) if rollup.key in keys
+            }
+            to_create, to_update, to_delete = [], [], []
+            for key in keys:
+                amount = totals.get(key)
+                rollup = existing.get(key)
+                if amount is None:
+                    if rollup is not None:
+                        to_delete.append(rollup.pk)
+                elif rollup is None:
+                    year, month, sales_rep_id, customer_id = key
+                    to_create.append(cls(
+                        year=year,
+                        month=month,
+                        sales_rep_id=sales_rep_id,
+                        customer_id=customer_id,
+                        amount=amount,
+                    ))
+                elif rollup.amount != amount:
+                    rollup.amount = amount
+                    to_update.append(rollup)
+            if to_delete:
+                cls.objects.filter(pk__in=to_delete).delete()
+            if to_update:
+                cls.objects.bulk_update(to_update, ['amount'])
+            if to_create:
+                cls.objects.bulk_create(to_create)
+
+    @classmethod
+    def rebuild(cls):
+        """Replace the whole rollup with a fresh aggregation of all dispatched orders, in the database."""
+        query = cls.get_live_totals_queryset().query
+        sql, params = query.sql_with_params()
+        # Rollup columns in the order the aggregation selects them
+        columns = {'year': 'year', 'month': 'month', 'order__sales_rep': 'sales_rep_id', 'order__customer': 'customer_id', 'total': 'amount'}
+        selected = [columns[name] for name in (*query.values_select, *query.annotation_select)]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cls.objects.all().delete()
+            cursor.execute(f'INSERT INTO {cls._meta.db_table} ({", ".join(selected)}) {sql}', params)
+
+    @classmethod
+    def get_sales_in_year_by_customers(cls, year):
+        return cls.objects.filter(year=year).values(
+            'month',
+            'customer',
+        ).annotate(
+            total=Sum('amount'),
+        ).values_list('month', 'total', 'customer__name').order_by(
+            'customer__email',
+            'month'
+        )
+
+    @classmethod
+    def get_sales_in_year_by_sales_rep(cls, year):
+        return cls.objects.filter(year=year).values(
+            'month',
+            'sales_rep',
+        ).annotate(
+            total=Sum('amount'),
+        ).values_list('month', 'total', 'sales_rep__email').order_by(
+            'sales_rep__email',
+            'month'
+        )
+
+
+class SalesReportSnapshot(models.Model):
+    """Rendered sales report tables for a year, regenerated in the background by Celery."""
+    year = models.PositiveSmallIntegerField(unique=True)
+    html = models.TextField()
+    generated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'Sales report {self.year} ({self.generated_at})'
+
+
+class OutboxMessage(models.Model):
+    """
+    Side effect of a change, written in the same transaction as the change itself.
+
+    The `relay_outbox` task hands pending messages over to Celery once the transaction committed,
+    so a message is neither sent for a rolled back change nor lost while the broker is down. A
+    message stays pending until its consumer delivered it, so one lost with its task is relayed
+    again once OUTBOX_DELIVERY_TIMEOUT has passed.
+    """
+    ORDER_CREATED = 'order_created'
+    EVENT_CHOICES = (
+        (ORDER_CREATED, 'Order created'),
+    )
+
+    event = models.CharField(max_length=32, choices=EVENT_CHOICES)
+    payload = JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    relayed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Relays so far, successful or not
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    # The next relay happens once this has passed: after a delay doubling with every failed attempt,
+    # or after OUTBOX_DELIVERY_TIMEOUT for a relayed message that wasn't delivered
+    next_attempt_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set by the consumer while it carries the message out, other consumers leave it alone until
+    # OUTBOX_DELIVERY_TIMEOUT has passed
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set by the consumer once the message was carried out, a repeated delivery skips it
+    delivered_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Only the undelivered messages are scanned by the relay, keep the index at queue depth
+            models.Index(fields=['id'], name='core_outbox_pending', condition=Q(delivered_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f'{self.get_event_display()} #{self.pk}'
+
+    @classmethod
+    def get_pending(cls):
+        """Messages to relay now: not delivered yet, not given up on and not waiting to be retried."""
+        return cls.objects.filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()),
+            delivered_at__isnull=True,
+            attempts__lt=settings.OUTBOX_MAX_ATTEMPTS,
+        )
+
+    @classmethod
+    def claim(cls, pk):
+        """
+        Claim message `pk` for delivery, returning whether it was claimed.
+
+        Only an undelivered message whose last claim expired can be claimed. The claim is a single
+        UPDATE, so of concurrent consumers only one claims the message.
+        """
+        now = timezone.now()
+        timeout = dt.timedelta(seconds=settings.OUTBOX_DELIVERY_TIMEOUT)
+        return bool(cls.objects.filter(
+            Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timeout),
+            pk=pk,
+            delivered_at__isnull=True,
+        ).update(claimed_at=now, next_attempt_at=now + timeout))
+
+    def get_retry_delay(self):
+        """Seconds until the next relay after `attempts` failed ones."""
+        return min(settings.OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
@@ -0,0 +1,62 @@
+from decimal import Decimal
+from itertools import groupby
+from operator import attrgetter
+
+from django.conf import settings
+
+from prolife.core.email_service import ORDER_CREATED_EMAIL
+from prolife.core.models import OrderedProduct
+
+
+def get_order_created_email(order, ordered_products):
+    """Return the (email_config, to_list, cc_list, custom_kwargs, from_email) announcing `order` with its lines."""
+    products = []
+    total_amount = Decimal('0.00')
+    for ordered_product in ordered_products:
+        amount = ordered_product.line_total
+        products.append({
+            'name': ordered_product.product.name,
+            'quantity': ordered_product.quantity,
+            'amount': amount,
+        })
+        total_amount += amount
+    customer = order.customer
+    return (
+        ORDER_CREATED_EMAIL,
+        settings.ORDER_CREATED_TO_EMAILS + [order.sales_rep.email],
+        settings.ORDER_CREATED_CC_EMAILS,
+        {
+            'order_url': order.url,
+            'order_id': order.id,
+            'order_notes': order.notes,
+            'products': products,
+            'customer_address': f'{customer.address}, {customer.city}, {customer.county}, {customer.postcode}',
+            'customer_phone': customer.phone_number,
+            'customer_mobile': customer.mobile,
+            'customer_email': customer.email,
+            'total_amount': f'£{total_amount} (EX VAT)',
+            'sales_rep_id': order.sales_rep.get_full_name(),
+        },
+        # Sent from DEFAULT_FROM_EMAIL
+        None,
+    )
+
+
+def get_order_created_emails(order_ids):
+    """
+    Return {order id: order created email} for the existing orders in `order_ids`.
+
+    The orders, their customers, sales reps and lines are loaded in a single query.
+    """
+    ordered_products = OrderedProduct.objects.filter(
+        order__in=order_ids,
+    ).select_related(
+        'order__customer',
+        'order__sales_rep',
+        'product',
+    ).order_by('order_id', 'id')
+    emails = {}
+    for order_id, lines in groupby(ordered_products, key=attrgetter('order_id')):
+        lines = list(lines)
+        emails[order_id] = get_order_created_email(lines[0].order, lines)
+    return emails
@@ -0,0 +1,165 @@
+import json
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import ModelIterable
+from django.utils.functional import cached_property
+
+# Cached page boundaries searched backwards from the requested page for the closest one to seek from
+KEYSET_LOOKBEHIND = 10
+
+
+def get_keyset_ordering(queryset):
+    """
+    Return the ordering of `queryset` as [(attname, descending)], or None if it can't be seeked.
+
+    Seeking needs plain non-null columns of the model ending with a unique one, so the ordering is total.
+    """
+    if queryset._iterable_class is not ModelIterable:
+        return None
+    query = queryset.query
+    opts = query.get_meta()
+    order_by = query.order_by or (opts.ordering if query.default_ordering else ())
+    ordering = []
+    for part in order_by:
+        if not isinstance(part, str) or part == '?':
+            return None
+        name = part.lstrip('-')
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.null or field.model is not opts.model:
+            return None
+        ordering.append((field.attname, part.startswith('-')))
+        if field.unique:
+            return ordering
+    return None
+
+
+def get_keyset_filter(ordering, key):
+    """
+    Match the rows ordered after the row with `key` values of the `ordering` columns.
+
+    The first column is also bounded on its own so an index on it limits the scan, the
+    equivalent row comparison isn't available to the ORM.
+    """
+    (first, first_descending), first_value = ordering[0], key[0]
+    condition = Q(**{f'{first}__lte' if first_descending else f'{first}__gte': first_value})
+    after = Q()
+    for position, ((attname, descending), value) in enumerate(zip(ordering, key)):
+        after |= Q(
+            **{f'{attname}__lt' if descending else f'{attname}__gt': value},
+            **{previous: previous_value for (previous, _), previous_value in zip(ordering[:position], key)}
+        )
+    return condition & after
+
+
+def estimate_count(queryset):
+    """Return the planner's row estimate for `queryset`, or None on other databases than PostgreSQL."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator whose count and pages stay cheap on large tables.
+
+    Results above ESTIMATED_COUNT_THRESHOLD rows are counted from the planner estimate instead of a
+    COUNT(*). The first and last rows of every served page are cached, and a page is then fetched by
+    seeking past the closest cached row before or after it instead of skipping all the rows up to
+    it, so paging through the results costs the same on every page. A page without a cached
+    neighbour is counted from the closer end of the results, in reverse order from the end, so the
+    first and last pages the admin links to are cheap too; only pages deep in the middle fall back
+    to a large OFFSET. Pages that can't be seeked, because the ordering isn't total, always use
+    OFFSET.
+
+    An estimated count is only approximate, more so for filtered or searched results, so the last
+    pages can be empty or some rows can't be reached by page number. Pages counted from the end
+    then show the actual last rows under the estimated page numbers.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True):
+        super().__init__(object_list, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page)
+        self.ordering = get_keyset_ordering(object_list) if hasattr(object_list, 'query') else None
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return super().count
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > settings.ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+        return self.object_list.count()
+
+    @cached_property
+    def boundary_key_prefix(self):
+        sql, params = self.object_list.query.sql_with_params()
+        digest = md5(f'{sql}:{params}:{self.per_page}'.encode()).hexdigest()
+        return f'keyset:{self.object_list.model._meta.label_lower}:{digest}'
+
+    def get_boundary(self, pages, edge):
+        """Return the first of `pages` whose `edge` ('first' or 'last') row is cached and its key, or (None, None)."""
+        keys = [f'{self.boundary_key_prefix}:{page}:{edge}' for page in pages]
+        boundaries = cache.get_many(keys)
+        for page, key in zip(pages, keys):
+            if boundaries.get(key) is not None:
+                return page, boundaries[key]
+        return None, None
+
+    def get_reversed(self):
+        """Return the results in reverse order and that ordering."""
+        ordering = [(attname, not descending) for attname, descending in self.ordering]
+        order_by = [f'-{attname}' if descending else attname for attname, descending in ordering]
+        return self.object_list.order_by(*order_by), ordering
+
+    def page(self, number):
+        if self.ordering is None:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        # Seek from the closest cached page before or after this one, or count from either end
+        before_page, before_key = self.get_boundary(
+            range(number - 1, max(number - 1 - KEYSET_LOOKBEHIND, 0), -1), 'last',
+        )
+        after_page, after_key = self.get_boundary(
+            range(number + 1, min(number + 1 + KEYSET_LOOKBEHIND, self.num_pages + 1)), 'first',
+        )
+        forward_skip = bottom - (before_page or 0) * self.per_page
+        backward_skip = (after_page - number - 1) * self.per_page if after_key is not None else self.count - top
+        if forward_skip <= backward_skip:
+            object_list = self.object_list
+            if before_key is not None:
+                object_list = object_list.filter(get_keyset_filter(self.ordering, before_key))
+            objects = list(object_list[forward_skip:forward_skip + top - bottom])
+        else:
+            object_list, ordering = self.get_reversed()
+            if after_key is not None:
+                object_list = object_list.filter(get_keyset_filter(ordering, after_key))
+            objects = list(object_list[backward_skip:backward_skip + top - bottom])[::-1]
+        if objects:
+            boundaries = {
+                f'{self.boundary_key_prefix}:{number}:{edge}': [getattr(obj, attname) for attname, _ in self.ordering]
+                for edge, obj in (('first', objects[0]), ('last', objects[-1]))
+            }
+            cache.set_many(
+                {key: values for key, values in boundaries.items() if None not in values},
+                settings.KEYSET_BOUNDARY_TIMEOUT,
+            )
+        return self._get_page(objects, number, self)
@@ -0,0 +1,111 @@
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import sentry_sdk
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Characters of the slowest query kept in the log line
+SLOWEST_QUERY_LENGTH = 1000
+
+_local = threading.local()
+
+
+class Profile:
+    """Wall time, SQL queries and named spans, e.g. `render`, recorded for a block of code."""
+
+    def __init__(self, name, extra):
+        self.name = name
+        # Context logged with the timings
+        self.extra = extra
+        self.duration = None
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.slowest_query = None
+        self.slowest_query_time = 0.0
+        self.spans = {}
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.query_count += 1
+            self.sql_time += duration
+            if duration > self.slowest_query_time:
+                self.slowest_query, self.slowest_query_time = sql, duration
+
+    def add_span(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def get_server_timing(self):
+        """Return the timings as a Server-Timing header value, in milliseconds."""
+        metrics = [
+            f'sql;dur={self.sql_time * 1000:.1f};desc="{self.query_count} queries"',
+            *(f'{name};dur={duration * 1000:.1f}' for name, duration in self.spans.items()),
+        ]
+        if self.duration is not None:
+            metrics.append(f'total;dur={self.duration * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'query_count': self.query_count,
+            'sql_ms': round(self.sql_time * 1000, 1),
+            'slowest_query_ms': round(self.slowest_query_time * 1000, 1),
+            'slowest_query': self.slowest_query[:SLOWEST_QUERY_LENGTH] if self.slowest_query else None,
+            **{f'{name}_ms': round(duration * 1000, 1) for name, duration in self.spans.items()},
+            **self.extra,
+        }
+
+
+def get_current_profile():
+    """Return the innermost profile running in this thread, or None."""
+    stack = getattr(_local, 'profiles', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def profile(name, **extra):
+    """
+    Record the wall time and SQL queries of the block and log them as one JSON line.
+
+    Yields the `Profile`, `extra` and whatever is added to its `extra` meanwhile go in the log line.
+    Profiles nest: the queries of an inner profile are counted by the outer ones too.
+    """
+    current = Profile(name, extra)
+    if not hasattr(_local, 'profiles'):
+        _local.profiles = []
+    _local.profiles.append(current)
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(current.execute_wrapper))
+            yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        _local.profiles.pop()
+        # Also recorded as a breadcrumb by Sentry's logging integration, the pinned SDK has no performance tracing
+        logger.info(json.dumps(current.as_dict(), default=str))
+
+
+@contextmanager
+def span(name):
+    """Time the block as span `name` of the current profile, if any; repeated spans add up."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = get_current_profile()
+        if current is not None:
+            duration = time.perf_counter() - start
+            current.add_span(name, duration)
+            sentry_sdk.add_breadcrumb(category='profile.span', message=name, data={'duration_ms': round(duration * 1000, 1)})
@@ -0,0 +1,129 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Sum
+from django.db.models.functions import Trunc
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.dates import MONTHS
+
+from prolife.core.models import MonthlySalesRollup, Order, OrderedProduct, SalesReportSnapshot
+from prolife.utils import PivotReport, bump_cache_version, get_cache_version
+
+logger = logging.getLogger(__name__)
+
+SALES_REPORT_VERSION_KEY = 'sales_report:version'
+# Part of the cache keys, bump when the cached report structure changes
+SALES_REPORT_FORMAT = 'pivot'
+SALES_REPORT_POLL_INTERVAL = 0.1
+
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+# Output columns per grouping dimension; the unique column keeps same-named entities apart
+DIMENSIONS = {
+    'sales_rep': {'sales_rep_email': 'order__sales_rep__email'},
+    'customer': {'customer_email': 'order__customer__email', 'customer_name': 'order__customer__name'},
+    'product': {'product_sku': 'product__sku', 'product_name': 'product__name'},
+    'county': {'county': 'order__customer__county'},
+}
+
+
+def get_sales_report_version():
+    return get_cache_version(SALES_REPORT_VERSION_KEY)
+
+
+def invalidate_sales_report():
+    """Move every cached sales report to a new data version."""
+    bump_cache_version(SALES_REPORT_VERSION_KEY)
+
+
+def build_sales_report(year):
+    return {
+        'sales_rep_report': PivotReport(MonthlySalesRollup.get_sales_in_year_by_sales_rep(year)),
+        'customers_report': PivotReport(MonthlySalesRollup.get_sales_in_year_by_customers(year)).top(),
+    }
+
+
+def get_sales_report(year):
+    """
+    Return the formatted sales report for `year`, computing it at most once per data version.
+
+    After an invalidation only the request holding the lock rebuilds the report; concurrent requests
+    are served the previous version meanwhile, or wait for the new one if there is none yet.
+    """
+    version = get_sales_report_version()
+    key = f'sales_report:{SALES_REPORT_FORMAT}:{year}:{version}'
+    report = cache.get(key)
+    if report is not None:
+        return report
+
+    lock_key = f'{key}:lock'
+    stale_key = f'sales_report:{SALES_REPORT_FORMAT}:{year}:stale'
+    if cache.add(lock_key, 1, settings.SALES_REPORT_LOCK_TIMEOUT):
+        try:
+            report = build_sales_report(year)
+            cache.set_many({key: report, stale_key: report}, settings.SALES_REPORT_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return report
+
+    report = cache.get(stale_key)
+    if report is not None:
+        return report
+    deadline = time.monotonic() + settings.SALES_REPORT_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(SALES_REPORT_POLL_INTERVAL)
+        report = cache.get(key)
+        if report is not None:
+            return report
+    logger.warning("Timed out waiting for the %s sales report, building it in this request.", year)
+    return build_sales_report(year)
+
+
+def store_sales_report(year):
+    """Render the report tables for `year` and store them for the sales view to serve."""
+    html = render_to_string('core/report/includes/sales_report.html', {
+        **get_sales_report(year),
+        'months': MONTHS,
+    })
+    snapshot, _ = SalesReportSnapshot.objects.update_or_create(
+        year=year,
+        defaults={'html': html, 'generated_at': timezone.now()},
+    )
+    return snapshot
+
+
+def get_dimension_columns(group_by):
+    """Map the output columns of the `group_by` dimensions to their lookups, in order."""
+    unknown = set(group_by) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f'Unknown dimension(s) {", ".join(sorted(unknown))}, expected any of {", ".join(DIMENSIONS)}')
+    columns = {}
+    for dimension in group_by:
+        columns.update(DIMENSIONS[dimension])
+    return columns
+
+
+def get_sales_breakdown(start, end, granularity='month', group_by=()):
+    """
+    Dispatched sales between `start` (inclusive) and `end` (exclusive) datetimes as a values queryset.
+
+    Lines are bucketed by `granularity` into a `period` column and grouped by the `group_by`
+    dimensions (keys of `DIMENSIONS`), with `amount` and `quantity` summed. The whole breakdown is
+    a single aggregate query; rows are ordered by period and then by the dimension columns.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown granularity {granularity!r}, expected one of {", ".join(GRANULARITIES)}')
+    columns = get_dimension_columns(group_by)
+    return OrderedProduct.objects.filter(
+        order__status=Order.DISPATCHED,
+        order__created_at__gte=start,
+        order__created_at__lt=end,
+    ).values(
+        period=Trunc('order__created_at', granularity),
+        **{column: F(path) for column, path in columns.items()}
+    ).annotate(
+        amount=Sum('line_total'),
+        quantity=Sum('quantity'),
+    ).order_by('period', *columns)
@@ -0,0 +1,109 @@
+import re
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from prolife.core.models import Product
+from prolife.utils import bump_cache_version, get_cache_version, normalize_phone_number
+
+# Bumped on every product change, part of the keys of everything cached from products
+PRODUCT_VERSION_KEY = 'product:version'
+# Number of matches cached per search, broader searches are only cached for the autocomplete
+PRODUCT_SEARCH_CACHE_LIMIT = 500
+# Shortest word the trigram indexes can match anywhere in a value, shorter words only match prefixes
+TRIGRAM_LENGTH = 3
+PHONE_NUMBER_RE = re.compile(r'^[\d\s()+-]+$')
+# Fewer digits than this are searched as text, a phone number prefix that short matches too many customers
+PHONE_NUMBER_MIN_DIGITS = 3
+
+
+def get_product_version():
+    return get_cache_version(PRODUCT_VERSION_KEY)
+
+
+def invalidate_products():
+    bump_cache_version(PRODUCT_VERSION_KEY)
+
+
+def get_product_search_filter(search_term):
+    """
+    Match products whose name or SKU contains every word of `search_term`.
+
+    Words too short for the trigram indexes are only matched anywhere when a longer word narrows
+    down the products, on their own they match the start of names and SKUs.
+    """
+    words = search_term.split()
+    lookup = 'icontains' if any(len(word) >= TRIGRAM_LENGTH for word in words) else 'istartswith'
+    condition = Q()
+    for word in words:
+        condition &= Q(**{f'name__{lookup}': word}) | Q(**{f'sku__{lookup}': word})
+    return condition
+
+
+def get_product_search_ids(search_term):
+    """
+    Return the ids of the first PRODUCT_SEARCH_CACHE_LIMIT + 1 products by name matching `search_term`.
+
+    A search for an exact SKU, as typed or in upper case, only returns that product. Results are
+    cached for PRODUCT_SEARCH_CACHE_TIMEOUT seconds or until a product changes, under the term as
+    typed since the SKU match depends on its case.
+    """
+    digest = md5(search_term.encode()).hexdigest()
+    key = f'product_search:{get_product_version()}:{digest}'
+    product_ids = cache.get(key)
+    if product_ids is None:
+        product_ids = list(
+            Product.objects.filter(sku__in={search_term, search_term.upper()}).values_list('pk', flat=True)
+        )
+        if not product_ids:
+            product_ids = list(
+                Product.objects.filter(
+                    get_product_search_filter(search_term),
+                ).values_list('pk', flat=True)[:PRODUCT_SEARCH_CACHE_LIMIT + 1]
+            )
+        cache.set(key, product_ids, settings.PRODUCT_SEARCH_CACHE_TIMEOUT)
+    return product_ids
+
+
+def search_products(queryset, search_term, truncate=False):
+    """
+    Filter `queryset` down to the products matching `search_term`.
+
+    Searches matching more than PRODUCT_SEARCH_CACHE_LIMIT products run uncached, unless `truncate`
+    is set: they are then cut down to the first matches by name, which is all a typeahead shows.
+    """
+    product_ids = get_product_search_ids(search_term)
+    if len(product_ids) > PRODUCT_SEARCH_CACHE_LIMIT and not truncate:
+        return queryset.filter(get_product_search_filter(search_term))
+    return queryset.filter(pk__in=product_ids[:PRODUCT_SEARCH_CACHE_LIMIT])
+
+
+def get_customer_search_filter(search_term):
+    """
+    Match customers on the index fitting `search_term`.
+
+    Input with an @ is matched against the start of the normalized emails and input made of phone
+    number characters against the start of the normalized phone and mobile numbers. Anything else
+    must be contained in the name or email, word by word.
+    """
+    if '@' in search_term:
+        return Q(email_normalized__startswith=search_term.strip().lower())
+    if PHONE_NUMBER_RE.match(search_term):
+        digits = normalize_phone_number(search_term)
+        if len(digits) >= PHONE_NUMBER_MIN_DIGITS:
+            return Q(phone_digits__startswith=digits) | Q(mobile_digits__startswith=digits)
+    words = search_term.split()
+    if any(len(word) >= TRIGRAM_LENGTH for word in words):
+        name_lookup, email_lookup = 'icontains', 'contains'
+    else:
+        name_lookup, email_lookup = 'istartswith', 'startswith'
+    condition = Q()
+    for word in words:
+        condition &= Q(**{f'name__{name_lookup}': word}) | Q(**{f'email_normalized__{email_lookup}': word.lower()})
+    return condition
+
+
+def search_customers(queryset, search_term):
+    return queryset.filter(get_customer_search_filter(search_term))
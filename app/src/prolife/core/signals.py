@@ -0,0 +1,86 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from prolife.core.models import Customer, MonthlySalesRollup, Order, OrderedProduct, Product
+from prolife.core.reports import invalidate_sales_report
+from prolife.core.search import invalidate_products
+
+_pending = threading.local()
+
+
+def refresh_rollup_on_commit(keys):
+    """
+    Queue rollup buckets for recomputation once the current transaction commits.
+
+    Keys are collected per thread so saving an order together with its inline lines refreshes
+    every touched bucket only once. The cached sales report is invalidated after the refresh, so
+    it's never rebuilt from a rollup that doesn't include the change yet.
+    """
+    if not hasattr(_pending, 'keys'):
+        _pending.keys = set()
+    _pending.keys.update(key for key in keys if key is not None)
+    transaction.on_commit(flush_pending_rollup_refresh)
+
+
+def flush_pending_rollup_refresh():
+    keys = getattr(_pending, 'keys', None)
+    if keys:
+        _pending.keys = set()
+        MonthlySalesRollup.refresh(keys)
+        invalidate_sales_report()
+
+
+@receiver(pre_save, sender=Order)
+def remember_order_rollup_state(sender, instance, raw, **kwargs):
+    if raw or instance.pk is None or hasattr(instance, '_loaded_rollup_key'):
+        return
+    loaded = Order.objects.filter(pk=instance.pk).only(*Order.ROLLUP_FIELDS).first()
+    instance._loaded_rollup_key = loaded._loaded_rollup_key if loaded else None
+
+
+@receiver(post_save, sender=Order)
+def refresh_order_rollup(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    keys = [getattr(instance, '_loaded_rollup_key', None)]
+    if instance.status == Order.DISPATCHED:
+        keys.append(instance.rollup_key)
+    refresh_rollup_on_commit(keys)
+    instance.remember_rollup_state()
+
+
+@receiver(post_delete, sender=Order)
+def refresh_deleted_order_rollup(sender, instance, **kwargs):
+    if instance.status == Order.DISPATCHED:
+        refresh_rollup_on_commit([instance.rollup_key])
+
+
+@receiver(post_save, sender=OrderedProduct)
+@receiver(post_delete, sender=OrderedProduct)
+def refresh_ordered_product_rollup(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The line's cached order may be stale, e.g. dispatched or redated through another instance
+    orders = Order.objects.filter(pk=instance.order_id, status=Order.DISPATCHED).only(*Order.ROLLUP_FIELDS)
+    refresh_rollup_on_commit([order.rollup_key for order in orders])
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=User)
+def invalidate_report_labels(sender, instance, created, raw, update_fields=None, **kwargs):
+    """Customer names and sales rep emails label the report rows."""
+    if raw or created or update_fields == frozenset(['last_login']):
+        return
+    transaction.on_commit(invalidate_sales_report)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_cached_products(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(invalidate_products)
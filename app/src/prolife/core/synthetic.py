@@ -0,0 +1,150 @@
+"""
+Synthetic customers, products, sales reps and orders for benchmarks and local load testing.
+
+Rows are inserted with set-based SQL, so millions of orders take minutes rather than hours, and
+from a seeded random sequence, so the same options generate the same data on an empty database.
+"""
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from prolife.core.models import MonthlySalesRollup, Order
+from prolife.core.reports import invalidate_sales_report
+
+COUNTIES = ('West Yorkshire', 'Greater London', 'Greater Manchester', 'Merseyside', 'Kent', 'Essex', 'Devon', 'Tyne and Wear')
+# Share of the generated orders in each status, the rest are processing
+DISPATCHED_SHARE = 0.8
+AWAITING_SHARE = 0.1
+MAX_LINE_QUANTITY = 10
+
+
+def get_max_id(table):
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+        return cursor.fetchone()[0]
+
+
+def seed_customers(count, start=0):
+    """Insert `count` customers numbered after `start` with random names, search keys included."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO core_customer (
+                email, name, phone_number, mobile, address, city, county, postcode,
+                email_normalized, phone_digits, mobile_digits
+            )
+            SELECT
+                'customer' || i || '@example' || (i %% 100) || '.com',
+                initcap(substr(md5(i::text), 1, 6)) || ' ' || initcap(substr(md5(i::text), 7, 8)) || ' Ltd',
+                '+44' || (7000000000 + i),
+                NULL,
+                i || ' High Street',
+                'Leeds',
+                (%s::text[])[1 + i %% %s],
+                'LS1 1AA',
+                'customer' || i || '@example' || (i %% 100) || '.com',
+                (7000000000 + i)::text,
+                NULL
+            FROM generate_series(%s + 1, %s + %s) AS i
+            """,
+            [list(COUNTIES), len(COUNTIES), start, start, count],
+        )
+        cursor.execute('ANALYZE core_customer')
+
+
+def seed_products(count, start=0):
+    """Insert `count` products numbered after `start`, priced between £1 and £200."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO core_product (name, sku, price)
+            SELECT 'Product ' || i, 'SYN' || lpad(i::text, 8, '0'), 1 + round((random() * 199)::numeric, 2)
+            FROM generate_series(%s + 1, %s + %s) AS i
+            """,
+            [start, start, count],
+        )
+
+
+def seed_sales_reps(count, start=0):
+    """Create `count` staff users who can't log in, numbered after `start`, return their ids."""
+    password = make_password(None)
+    reps = User.objects.bulk_create(
+        User(username=f'rep{i}', email=f'rep{i}@example.com', password=password, is_staff=True)
+        for i in range(start + 1, start + count + 1)
+    )
+    return list(User.objects.filter(username__in=[rep.username for rep in reps]).values_list('pk', flat=True))
+
+
+def seed_orders(count, sales_rep_ids, years, lines_per_order):
+    """
+    Insert `count` orders over the last `years` years with 1 to `lines_per_order` lines each.
+
+    Orders go to every existing customer, skewed towards a few large ones, and their lines to
+    distinct existing products at the current prices.
+    """
+    start = get_max_id('core_order')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO core_order (sales_rep_id, customer_id, status, notes, created_at)
+            SELECT
+                reps[1 + floor(random() * array_length(reps, 1))::int],
+                customers[1 + floor(power(random(), 3) * array_length(customers, 1))::int],
+                CASE
+                    WHEN o.status < %s THEN %s
+                    WHEN o.status < %s THEN %s
+                    ELSE %s
+                END,
+                NULL,
+                now() - random() * %s * interval '365 days'
+            FROM
+                (SELECT random() AS status FROM generate_series(1, %s)) AS o,
+                (SELECT %s::int[]) AS r(reps),
+                (SELECT array_agg(id ORDER BY id) FROM core_customer) AS c(customers)
+            """,
+            [
+                DISPATCHED_SHARE, Order.DISPATCHED,
+                DISPATCHED_SHARE + AWAITING_SHARE, Order.AWAITING_CUSTOMER_RESPONSE,
+                Order.PROCESSING,
+                years,
+                count,
+                list(sales_rep_ids),
+            ],
+        )
+        cursor.execute(
+            """
+            INSERT INTO core_orderedproduct (order_id, product_id, quantity, unit_price, line_total)
+            SELECT o.id, p.id, l.quantity, p.price, l.quantity * p.price
+            FROM
+                (SELECT array_agg(id ORDER BY id) FROM core_product) AS pr(products),
+                LATERAL (
+                    SELECT
+                        id,
+                        floor(random() * array_length(products, 1))::int AS first_product,
+                        least(1 + floor(random() * %s)::int, array_length(products, 1)) AS lines
+                    FROM core_order
+                    WHERE id > %s
+                ) AS o,
+                LATERAL (
+                    SELECT j, 1 + floor(random() * %s)::int AS quantity FROM generate_series(0, o.lines - 1) AS j
+                ) AS l,
+                core_product p
+            WHERE p.id = products[1 + (o.first_product + l.j) %% array_length(products, 1)]
+            """,
+            [lines_per_order, start, MAX_LINE_QUANTITY],
+        )
+
+
+def generate_synthetic_data(customers, products, sales_reps, orders, years=5, lines_per_order=5, seed=0):
+    """Add the given numbers of rows, then rebuild the sales rollup and refresh the planner statistics."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', [seed / 2 ** 31 % 1])
+        seed_customers(customers, start=get_max_id('core_customer'))
+        seed_products(products, start=get_max_id('core_product'))
+        sales_rep_ids = seed_sales_reps(sales_reps, start=get_max_id('auth_user'))
+        seed_orders(orders, sales_rep_ids, years, lines_per_order)
+        MonthlySalesRollup.rebuild()
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    invalidate_sales_report()
@@ -1,17 +1,250 @@
+import datetime as dt
+import smtplib
+import time
+from itertools import groupby
+from operator import attrgetter
+
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun, task_retry, worker_process_init
 from celery.utils.log import get_task_logger
+from constance import config
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from prolife.celery import app
-from prolife.core.email_service import EmailService
+from prolife.core.connections import close_unhealthy_connections
+from prolife.core.email_service import (
+    EmailService,
+    close_pooled_connection,
+    get_pooled_connection,
+    warm_email_templates,
+)
+from prolife.core.metrics import increment, observe
+from prolife.core.models import OutboxMessage
+from prolife.core.notifications import get_order_created_emails
+from prolife.core.reports import store_sales_report
 
 logger = get_task_logger(__name__)
 
+EMAIL_RETRY_DELAY = 60
+# Raised by smtplib on protocol errors and by the socket layer on dropped connections
+EMAIL_SEND_ERRORS = (smtplib.SMTPException, OSError)
 
-@app.task
-def send_email(email_config, to_list, cc_list, custom_kwargs, from_email=None):
+
+# Start times of the tasks running in this worker process, by task id
+_task_started_at = {}
+
+
+@worker_process_init.connect
+def warm_email_service(**kwargs):
+    warm_email_templates()
+
+
+@task_prerun.connect
+def check_connections_on_task(task=None, **kwargs):
+    # Celery's Django fixup already closes the connections older than CONN_MAX_AGE before each task,
+    # eager tasks run inside the caller's request or transaction
+    if not task.request.is_eager:
+        close_unhealthy_connections()
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    # Custom headers are passed on to the worker as attributes of `task.request`
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def observe_task_queue_time(task_id=None, task=None, **kwargs):
+    _task_started_at[task_id] = time.perf_counter()
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is None:
+        return
+    # A task delayed with a countdown or an ETA only starts waiting in the queue once it's due
+    eta = parse_datetime(task.request.eta) if isinstance(task.request.eta, str) else task.request.eta
+    queued_since = max(published_at, eta.timestamp()) if eta else published_at
+    observe('celery_task_queue_seconds', max(time.time() - queued_since, 0), task=task.name)
+
+
+@task_postrun.connect
+def observe_task_run_time(task_id=None, task=None, state=None, **kwargs):
+    started_at = _task_started_at.pop(task_id, None)
+    if started_at is not None:
+        observe('celery_task_run_seconds', time.perf_counter() - started_at, task=task.name, state=state)
+
+
+@task_retry.connect
+def count_task_retry(sender=None, **kwargs):
+    increment('celery_task_retries_total', task=sender.name)
+
+
+@task_failure.connect
+def count_task_failure(sender=None, exception=None, **kwargs):
+    increment('celery_task_failures_total', task=sender.name, exception=type(exception).__name__)
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=EMAIL_RETRY_DELAY)
+def send_email(self, email_config, to_list, cc_list, custom_kwargs, from_email=None):
+    email_service = EmailService(email_config)
+    try:
+        email_service.send(
+            to_list,
+            cc_list,
+            from_email=from_email,
+            connection=get_pooled_connection(),
+            **custom_kwargs,
+        )
+    except EMAIL_SEND_ERRORS as e:
+        close_pooled_connection()
+        raise self.retry(exc=e)
+
+
+def send_pooled_email(email_config, to_list, cc_list, custom_kwargs, from_email=None):
+    """
+    Send an email over the pooled connection.
+
+    The server may have dropped the pooled connection, so a failed send is retried once on a fresh
+    one before the error is raised.
+    """
     email_service = EmailService(email_config)
-    email_service.send(
-        to_list,
-        cc_list,
-        from_email=from_email,
-        **custom_kwargs,
-    )
+    for attempt in range(2):
+        try:
+            email_service.send(
+                to_list,
+                cc_list,
+                from_email=from_email,
+                connection=get_pooled_connection(),
+                **custom_kwargs,
+            )
+            return
+        except EMAIL_SEND_ERRORS:
+            close_pooled_connection()
+            if attempt:
+                raise
+
+
+def send_email_batch(emails):
+    """
+    Send (email_config, to_list, cc_list, custom_kwargs, from_email) emails over the pooled connection.
+
+    An email the SMTP server keeps failing is handed over to a `send_email` task that retries later,
+    one that fails otherwise, e.g. to render, is logged and skipped so the rest of the batch is still
+    sent.
+    """
+    for email in emails:
+        try:
+            send_pooled_email(*email)
+        except SoftTimeLimitExceeded:
+            raise
+        except EMAIL_SEND_ERRORS:
+            logger.exception("Sending email to %s failed, retrying it separately.", email[1])
+            send_email.apply_async(email[:4], {'from_email': email[4]}, countdown=EMAIL_RETRY_DELAY)
+        except Exception:
+            logger.exception("Sending email to %s failed, skipping it.", email[1])
+
+
+@app.task
+def send_order_created_messages(message_ids):
+    """
+    Send the order created emails of outbox messages `message_ids`, each at most once.
+
+    The relay may publish this task twice for a message, e.g. when its transaction fails to commit
+    after publishing, or again once a lost task's OUTBOX_DELIVERY_TIMEOUT passed. Each message is
+    claimed before its email is sent, outside of any transaction, and marked delivered once sent, so
+    a second task skips it. Claiming waits for the row lock of the relay that published the task.
+
+    A message whose email fails is released to be relayed again after the retry delay.
+    """
+    messages = list(OutboxMessage.objects.filter(pk__in=message_ids, delivered_at__isnull=True).order_by('pk'))
+    emails = get_order_created_emails({message.payload['order_id'] for message in messages})
+    for message in messages:
+        if not OutboxMessage.claim(message.pk):
+            continue
+        email = emails.get(message.payload['order_id'])
+        try:
+            # The order may have been deleted meanwhile
+            if email is not None:
+                send_pooled_email(*email)
+        except Exception as e:
+            logger.exception("Sending the email of outbox message %s failed.", message.pk)
+            OutboxMessage.objects.filter(pk=message.pk).update(
+                claimed_at=None,
+                next_attempt_at=timezone.now() + dt.timedelta(seconds=message.get_retry_delay()),
+            )
+            if isinstance(e, SoftTimeLimitExceeded):
+                raise
+        else:
+            OutboxMessage.objects.filter(pk=message.pk).update(delivered_at=timezone.now())
+
+
+def relay_order_created(messages):
+    send_order_created_messages.delay([message.pk for message in messages])
+
+
+# Each handler relays a batch of messages with its event
+OUTBOX_HANDLERS = {
+    OutboxMessage.ORDER_CREATED: relay_order_created,
+}
+
+
+@app.task
+def relay_outbox():
+    """
+    Hand pending outbox messages over to their handlers, OUTBOX_BATCH_SIZE at a time.
+
+    A batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED and marked relayed in the same
+    transaction, so concurrent relays never pick up the same message. A relayed message stays
+    pending until its consumer delivered it and is relayed again after OUTBOX_DELIVERY_TIMEOUT, so
+    a message is handed over at least once; the consumers claim messages so they carry each out
+    once. Messages whose handler fails are retried after a growing delay, until they have been
+    attempted OUTBOX_MAX_ATTEMPTS times.
+    """
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            messages = list(
+                OutboxMessage.get_pending().filter(id__gt=last_id).select_for_update(skip_locked=True).order_by('id')[
+                    :settings.OUTBOX_BATCH_SIZE
+                ]
+            )
+            if not messages:
+                break
+            relayed, failed = [], []
+            for event, event_messages in groupby(sorted(messages, key=attrgetter('event')), key=attrgetter('event')):
+                event_messages = list(event_messages)
+                try:
+                    with transaction.atomic():
+                        OUTBOX_HANDLERS[event](event_messages)
+                except Exception:
+                    logger.exception(
+                        "Relaying %s outbox messages %s failed.", event, [message.pk for message in event_messages],
+                    )
+                    failed.extend(event_messages)
+                else:
+                    relayed.extend(event_messages)
+            now = timezone.now()
+            for message in relayed:
+                message.relayed_at = now
+                message.next_attempt_at = now + dt.timedelta(seconds=settings.OUTBOX_DELIVERY_TIMEOUT)
+            for message in messages:
+                message.attempts += 1
+            for message in failed:
+                message.next_attempt_at = now + dt.timedelta(seconds=message.get_retry_delay())
+            OutboxMessage.objects.bulk_update(messages, ['relayed_at', 'attempts', 'next_attempt_at'])
+        last_id = messages[-1].pk
+        logger.info("Relayed %s outbox messages, %s failed.", len(relayed), len(failed))
+
+
+@app.task
+def refresh_sales_report(year):
+    snapshot = store_sales_report(year)
+    logger.info("Stored sales report for %s generated at %s.", year, snapshot.generated_at)
+
+
+@app.task
+def precompute_sales_reports():
+    for year in (config.YEAR, config.YEAR - 1):
+        refresh_sales_report(year)
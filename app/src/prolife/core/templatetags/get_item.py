@@ -1,8 +0,0 @@
-from django import template
-
-register = template.Library()
-
-
-@register.filter
-def get_item(dictionary, key):
-    return dictionary.get(key)
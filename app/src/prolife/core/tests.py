@@ -1,3 +1,1081 @@
-from django.test import TestCase
+import csv
+import datetime as dt
+import json
+import threading
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import redis
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.template import TemplateDoesNotExist
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from prolife.core.admin import CustomModelAdmin
+from prolife.core.connections import close_unhealthy_connections
+from prolife.core.email_service import WELCOME_EMAIL
+from prolife.core.exports import ORDER_LINE_COLUMNS
+from prolife.core.imports import OrderImporter, read_rows
+from prolife.core import metrics
+from prolife.core.metrics import get_histogram_lines, get_metrics_redis, observe
+from prolife.core.models import Customer, MonthlySalesRollup, Order, OrderedProduct, OutboxMessage, Product
+from prolife.core.pagination import KeysetPaginator, get_keyset_filter
+from prolife.core.profiling import profile, span
+from prolife.core.reports import (
+    SALES_REPORT_FORMAT,
+    build_sales_report,
+    get_sales_report,
+    get_sales_report_version,
+    invalidate_sales_report,
+)
+from prolife.core.search import (
+    get_customer_search_filter,
+    get_product_search_filter,
+    search_customers,
+    search_products,
+)
+from prolife.core.signals import flush_pending_rollup_refresh
+from prolife.core.synthetic import generate_synthetic_data
+from prolife.core.tasks import OUTBOX_HANDLERS, relay_outbox, send_email_batch, send_order_created_messages
+from prolife.core.transitions import transition_orders
+from prolife.utils import PivotReport, get_formatted_report, normalize_phone_number
+
+SEED_YEARS = 5
+SEED_ORDERS = 3000
+
+
+def seed_orders(sales_reps=5, customers=50, products=50, orders=SEED_ORDERS, lines_per_order=3):
+    """Create a deterministic dataset with orders spread over `SEED_YEARS` years."""
+    reps = User.objects.bulk_create(
+        User(username=f'rep{i}', email=f'rep{i}@example.com', is_staff=True) for i in range(sales_reps)
+    )
+    reps = list(User.objects.filter(username__in=[rep.username for rep in reps]))
+    customer_list = [
+        Customer(
+            email=f'customer{i}@example.com',
+            name=f'Customer {i}',
+            phone_number=f'+44{i:09d}',
+            address='1 High Street',
+            city='Leeds',
+            county='West Yorkshire',
+            postcode='LS1 1AA',
+        )
+        for i in range(customers)
+    ]
+    for customer in customer_list:
+        customer.set_search_keys()
+    customer_list = Customer.objects.bulk_create(customer_list)
+    product_list = Product.objects.bulk_create(
+        Product(name=f'Product {i}', sku=f'SKU{i:05d}', price=Decimal(i % 20 + 1)) for i in range(products)
+    )
+    statuses = [status for status, _ in Order.STATUS_CHOICES]
+    order_list = Order.objects.bulk_create(
+        Order(
+            sales_rep=reps[i % len(reps)],
+            customer=customer_list[i % len(customer_list)],
+            status=statuses[i % len(statuses)],
+        )
+        for i in range(orders)
+    )
+    lines = []
+    for i, order in enumerate(order_list):
+        for j in range(lines_per_order):
+            product = product_list[(i + j) % len(product_list)]
+            lines.append(OrderedProduct(
+                order=order,
+                product=product,
+                quantity=j + 1,
+                unit_price=product.price,
+                line_total=(j + 1) * product.price,
+            ))
+    OrderedProduct.objects.bulk_create(lines)
+    with connection.cursor() as cursor:
+        # bulk_create() honours auto_now_add, so spread the orders over the seeded years afterwards
+        cursor.execute(
+            "UPDATE core_order SET created_at = now() - (id %% %s) * interval '1 day'",
+            [SEED_YEARS * 365],
+        )
+        cursor.execute('ANALYZE')
+    MonthlySalesRollup.rebuild()
+    return reps
+
+
+def get_plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from get_plan_nodes(child)
+
+
+class MonthlySalesRollupTest(TestCase):
+    """Every change to orders and their lines keeps the rollup equal to the live totals."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(sales_reps=2, customers=3, products=10, orders=12, lines_per_order=2)
+
+    def assertRollupMatchesLiveTotals(self):
+        flush_pending_rollup_refresh()
+        rollups = {rollup.key: rollup.amount for rollup in MonthlySalesRollup.objects.all()}
+        self.assertEqual(rollups, MonthlySalesRollup.get_live_totals())
+
+    def get_order(self, status):
+        return Order.objects.filter(status=status).order_by('pk').first()
+
+    def get_unused_product(self, order):
+        return Product.objects.exclude(orderedproduct__order=order).order_by('pk').first()
+
+    def test_status_changes(self):
+        order = self.get_order(Order.PROCESSING)
+        order.status = Order.DISPATCHED
+        order.save()
+        self.assertRollupMatchesLiveTotals()
+        order.status = Order.AWAITING_CUSTOMER_RESPONSE
+        order.save()
+        self.assertRollupMatchesLiveTotals()
+
+    def test_created_at_change(self):
+        order = self.get_order(Order.DISPATCHED)
+        order.created_at -= dt.timedelta(days=100)
+        order.save()
+        self.assertRollupMatchesLiveTotals()
+
+    def test_add_edit_and_delete_lines(self):
+        order = self.get_order(Order.DISPATCHED)
+        line = OrderedProduct.objects.create(order=order, product=self.get_unused_product(order), quantity=3)
+        self.assertRollupMatchesLiveTotals()
+        line.quantity = 5
+        line.save()
+        self.assertRollupMatchesLiveTotals()
+        line.product = self.get_unused_product(order)
+        line.save()
+        self.assertRollupMatchesLiveTotals()
+        line.delete()
+        self.assertRollupMatchesLiveTotals()
+
+    def test_lines_with_stale_cached_order(self):
+        order = self.get_order(Order.PROCESSING)
+        lines = list(OrderedProduct.objects.filter(order=order).select_related('order'))
+        other = Order.objects.get(pk=order.pk)
+        other.status = Order.DISPATCHED
+        other.save()
+        self.assertRollupMatchesLiveTotals()
+        # The lines still hold the processing order
+        lines[0].product = self.get_unused_product(order)
+        lines[0].save()
+        self.assertRollupMatchesLiveTotals()
+        lines[1].delete()
+        self.assertRollupMatchesLiveTotals()
+
+    def test_delete_order(self):
+        self.get_order(Order.DISPATCHED).delete()
+        self.assertRollupMatchesLiveTotals()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are only checked on PostgreSQL')
+class QueryPlanTest(TestCase):
+    """
+    EXPLAIN the report and admin changelist queries and fail on sequential scans.
+
+    The seeded dataset is too small for the planner to prefer indexes on its own, so sequential
+    scans are disabled for the transaction: the planner then only falls back to one when no index
+    can serve the query, e.g. after a non-sargable filter or a dropped index.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sales_reps = seed_orders()
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.year = Order.objects.latest('created_at').created_at.year
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertNoSeqScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0][0]['Plan']
+        seq_scans = [node['Relation Name'] for node in get_plan_nodes(plan) if node['Node Type'] == 'Seq Scan']
+        self.assertEqual(seq_scans, [], f'Sequential scan in plan for: {queryset.query}')
+
+    def get_changelist(self, user, **params):
+        request = RequestFactory().get('/core/order/', params)
+        request.user = user
+        return site._registry[Order].get_changelist_instance(request)
+
+    def test_live_report_queries(self):
+        self.assertNoSeqScan(Order.get_dispatched_order_in_year_by_sales_rep(self.year))
+        self.assertNoSeqScan(Order.get_dispatched_order_in_year_by_customers(self.year))
+
+    def test_rollup_report_queries(self):
+        self.assertNoSeqScan(MonthlySalesRollup.get_sales_in_year_by_sales_rep(self.year))
+        self.assertNoSeqScan(MonthlySalesRollup.get_sales_in_year_by_customers(self.year))
+
+    def get_next_page_queryset(self, changelist):
+        """Return the query seeking the page after the changelist's current one."""
+        ordering = changelist.paginator.ordering
+        key = [getattr(changelist.result_list[-1], attname) for attname, _ in ordering]
+        return changelist.queryset.filter(get_keyset_filter(ordering, key))[:changelist.list_per_page]
+
+    def test_changelist_status_filter(self):
+        changelist = self.get_changelist(self.superuser, status=Order.DISPATCHED)
+        self.assertNoSeqScan(changelist.queryset)
+        self.assertNoSeqScan(self.get_next_page_queryset(changelist))
+
+    def test_changelist_sales_rep_queryset(self):
+        changelist = self.get_changelist(self.sales_reps[0])
+        self.assertNoSeqScan(changelist.queryset)
+        self.assertNoSeqScan(self.get_next_page_queryset(changelist))
+
+    def test_changelist_unfiltered(self):
+        changelist = self.get_changelist(self.superuser)
+        self.assertNoSeqScan(self.get_next_page_queryset(changelist))
+
+    def test_product_search(self):
+        for search_term in ['roduct 1', 'sku0004', 'pr', 'product 4']:
+            with self.subTest(search_term=search_term):
+                self.assertNoSeqScan(Product.objects.filter(get_product_search_filter(search_term)))
+
+    def test_customer_search(self):
+        for search_term in ['ustomer 1', 'Customer1@Example', '+44 000 000 01', '07', 'stomer1@ex']:
+            with self.subTest(search_term=search_term):
+                self.assertNoSeqScan(Customer.objects.filter(get_customer_search_filter(search_term)))
+
+
+class ChangelistQueryBudgetTest(TestCase):
+    """Render every budgeted `CustomModelAdmin` changelist with a full page of rows."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(customers=150, products=150, orders=150, lines_per_order=1)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+
+    def test_changelist_query_budget(self):
+        for model, model_admin in site._registry.items():
+            if not isinstance(model_admin, CustomModelAdmin) or model_admin.changelist_query_budget is None:
+                continue
+            with self.subTest(model=model._meta.label):
+                url = reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_changelist')
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.context['cl'].result_list), model_admin.list_per_page)
+                self.assertLessEqual(
+                    len(context.captured_queries),
+                    model_admin.changelist_query_budget,
+                    '\n'.join(query['sql'] for query in context.captured_queries),
+                )
+
+
+class ProductSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create([
+            Product(name='Gadget 1', sku='abc-1', price=1),
+            Product(name='Gadget 2', sku='abc-10', price=1),
+            Product(name='Gadget 3', sku='GD-3', price=1),
+            Product(name='Widget', sku='WD-1', price=1),
+        ])
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, search_term, truncate=False):
+        products = search_products(Product.objects.all(), search_term, truncate=truncate)
+        return list(products.values_list('sku', flat=True))
+
+    def test_exact_sku_only_returns_that_product(self):
+        self.assertEqual(self.search('abc-1'), ['abc-1'])
+        self.assertEqual(self.search('gd-3'), ['GD-3'])
+        # Not an exact SKU in another case, so matched anywhere
+        self.assertEqual(self.search('ABC-1'), ['abc-1', 'abc-10'])
+
+    def test_words_match_names_and_skus(self):
+        self.assertEqual(self.search('gadget wd'), [])
+        self.assertEqual(self.search('get 3'), ['GD-3'])
+        self.assertEqual(self.search('g'), ['abc-1', 'abc-10', 'GD-3'])
+
+    @mock.patch('prolife.core.search.PRODUCT_SEARCH_CACHE_LIMIT', 2)
+    def test_broad_searches_are_only_truncated_for_the_autocomplete(self):
+        self.assertEqual(self.search('gadget'), ['abc-1', 'abc-10', 'GD-3'])
+        self.assertEqual(self.search('gadget', truncate=True), ['abc-1', 'abc-10'])
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('admin:core_product_changelist'), {'q': 'gadget'})
+        self.assertEqual(len(response.context['cl'].result_list), 3)
+        response = self.client.get(reverse('admin:core_product_autocomplete'), {'term': 'gadget'})
+        self.assertEqual([result['text'] for result in response.json()['results']], [
+            str(product) for product in Product.objects.filter(sku__in=['abc-1', 'abc-10'])
+        ])
+
+    def test_product_changes_invalidate_the_cached_searches(self):
+        self.assertEqual(self.search('widget'), ['WD-1'])
+        # Run the invalidation scheduled for the commit right away, TestCase never commits
+        with mock.patch('prolife.core.signals.transaction.on_commit', side_effect=lambda func: func()):
+            Product.objects.create(name='Widget 2', sku='WD-2', price=1)
+        self.assertEqual(self.search('widget'), ['WD-1', 'WD-2'])
+
+
+class CustomerSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        address = {'address': '1 High Street', 'city': 'Leeds', 'county': 'West Yorkshire', 'postcode': 'LS1 1AA'}
+        Customer.objects.create(
+            name='Alice Smith', email='Alice.Smith@Example.com', phone_number='07700900123', **address,
+        )
+        Customer.objects.create(
+            name='Bob Jones', email='bob@example.org', phone_number='+441134960000', mobile='+447700900999', **address,
+        )
+        Customer.objects.create(name='Al Brown', email='al@brown.com', phone_number='01134960111', **address)
+
+    def search(self, search_term):
+        return sorted(search_customers(Customer.objects.all(), search_term).values_list('name', flat=True))
+
+    def test_normalize_phone_number(self):
+        for phone_number in ['07700900123', '+44 7700 900123', '0044 (0)7700-900123', '7700900123']:
+            with self.subTest(phone_number=phone_number):
+                self.assertEqual(normalize_phone_number(phone_number), '7700900123')
+        self.assertEqual(normalize_phone_number(None), '')
+
+    def test_phone_numbers_match_in_any_format(self):
+        self.assertEqual(self.search('+44 7700 900123'), ['Alice Smith'])
+        self.assertEqual(self.search('0113 496'), ['Al Brown', 'Bob Jones'])
+        # Mobile numbers too
+        self.assertEqual(self.search('07700 900999'), ['Bob Jones'])
+        self.assertEqual(
+            get_customer_search_filter('+44 7700'),
+            Q(phone_digits__startswith='7700') | Q(mobile_digits__startswith='7700'),
+        )
+
+    def test_emails_match_their_start(self):
+        self.assertEqual(get_customer_search_filter(' ALICE.smith@ '), Q(email_normalized__startswith='alice.smith@'))
+        self.assertEqual(self.search('alice.smith@example'), ['Alice Smith'])
+        self.assertEqual(self.search('smith@example.com'), [])
+
+    def test_words_match_names_and_emails(self):
+        self.assertEqual(self.search('smith'), ['Alice Smith'])
+        self.assertEqual(self.search('example'), ['Alice Smith', 'Bob Jones'])
+        self.assertEqual(self.search('bob jones'), ['Bob Jones'])
+        # Short words on their own only match the start of names and emails
+        self.assertEqual(self.search('al'), ['Al Brown', 'Alice Smith'])
+        self.assertEqual(self.search('ob'), [])
+        # But anywhere next to a longer word
+        self.assertEqual(self.search('ob example'), ['Bob Jones'])
+
+
+class KeysetPaginatorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=250, lines_per_order=1)
+        # Ties on created_at must be broken by the id
+        Order.objects.filter(pk__in=Order.objects.order_by('pk').values('pk')[:100]).update(
+            created_at=Order.objects.earliest('created_at').created_at,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_seeked_pages_match_offset_pages(self):
+        queryset = Order.objects.order_by('-created_at', '-id')
+        expected = list(queryset.values_list('pk', flat=True))
+        paginator = KeysetPaginator(queryset, 30)
+        for number in paginator.page_range:
+            with self.subTest(page=number):
+                page_ids = [order.pk for order in paginator.page(number)]
+                self.assertEqual(page_ids, expected[(number - 1) * 30:number * 30])
+
+    def test_page_without_earlier_boundary(self):
+        queryset = Order.objects.order_by('-created_at', '-id')
+        expected = list(queryset.values_list('pk', flat=True))
+        page = KeysetPaginator(queryset, 30).page(5)
+        self.assertEqual([order.pk for order in page], expected[120:150])
+        self.assertEqual([order.pk for order in KeysetPaginator(queryset, 30).page(6)], expected[150:180])
+
+    def test_pages_seeked_backwards_from_the_last_page(self):
+        queryset = Order.objects.order_by('-created_at', '-id')
+        expected = list(queryset.values_list('pk', flat=True))
+        paginator = KeysetPaginator(queryset, 30)
+        for number in reversed(paginator.page_range):
+            with self.subTest(page=number), CaptureQueriesContext(connection) as context:
+                page_ids = [order.pk for order in paginator.page(number)]
+                self.assertEqual(page_ids, expected[(number - 1) * 30:number * 30])
+                self.assertNotIn('OFFSET', context.captured_queries[-1]['sql'])
+
+    def test_last_pages_of_an_estimated_count(self):
+        connection.cursor().execute('ANALYZE core_order')
+        queryset = Order.objects.order_by('-created_at', '-id')
+        expected = list(queryset.values_list('pk', flat=True))
+        with override_settings(ESTIMATED_COUNT_THRESHOLD=0):
+            paginator = KeysetPaginator(queryset, 30)
+            last_page = paginator.page(paginator.num_pages)
+            # The actual last rows, whatever the estimate
+            self.assertEqual([order.pk for order in last_page], expected[-len(last_page):])
+            previous_page = paginator.page(paginator.num_pages - 1)
+            self.assertEqual([order.pk for order in previous_page], expected[-len(last_page) - 30:-len(last_page)])
+
+    def test_ordering_without_total_order_uses_offset(self):
+        self.assertIsNone(KeysetPaginator(Order.objects.order_by('-created_at'), 30).ordering)
+        self.assertIsNone(KeysetPaginator(Order.objects.order_by('customer__name', 'id'), 30).ordering)
+        self.assertEqual(
+            KeysetPaginator(Order.objects.order_by('status', '-pk'), 30).ordering,
+            [('status', False), ('id', True)],
+        )
+
+
+class OrderChangeFormQueryTest(TestCase):
+    """The order form must not query per line, orders can have hundreds of them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(sales_reps=1, orders=2, lines_per_order=1)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.orders = list(Order.objects.order_by('pk'))
+        products = list(Product.objects.exclude(orderedproduct__order=cls.orders[1]).order_by('pk')[:40])
+        OrderedProduct.objects.bulk_create(
+            OrderedProduct(order=cls.orders[1], product=product, quantity=1, unit_price=product.price, line_total=product.price)
+            for product in products
+        )
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+
+    def get_query_count(self, order):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:core_order_change', args=[order.pk]))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_independent_of_lines(self):
+        # Warm the per-process caches, e.g. of content types
+        self.get_query_count(self.orders[0])
+        self.assertEqual(self.get_query_count(self.orders[0]), self.get_query_count(self.orders[1]))
+
+    def test_saved_lines_keep_their_unit_price(self):
+        line = OrderedProduct.objects.filter(order=self.orders[0]).get()
+        Product.objects.filter(pk=line.product_id).update(price=line.unit_price + 10)
+        response = self.client.get(reverse('admin:core_order_change', args=[self.orders[0].pk]))
+        saved_prices = json.loads(response.context['inline_admin_formsets'][0].formset.get_saved_prices())
+        self.assertEqual(saved_prices, {str(line.pk): {'product': line.product_id, 'unit_price': str(line.unit_price)}})
+
+
+class OrderImportTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sales_reps = seed_orders(customers=5, products=20, orders=5, lines_per_order=1)
+
+    def get_csv(self, orders):
+        lines = ['order_ref,customer_email,product_sku,quantity,sales_rep_email,status']
+        for order in range(orders):
+            for line in range(3):
+                lines.append(f'ref{order},Customer{order % 5}@example.com,SKU{order % 10 + line:05d},2,rep0@example.com,dispatched')
+        return lines
+
+    def test_import(self):
+        lines = self.get_csv(10)
+        lines.append('ref10,nobody@example.com,SKU00000,1,,')
+        lines.append('ref11,customer0@example.com,SKU00000,0,,')
+        # Emails match in any case
+        lines.append('ref12,CUSTOMER1@example.com,SKU00000,1,Rep0@Example.com,')
+        last_pk = Order.objects.latest('pk').pk
+        importer = OrderImporter(default_sales_rep=self.sales_reps[1], batch_size=4).run(read_rows(lines, 'csv'))
+        self.assertEqual((importer.orders, importer.lines), (11, 31))
+        self.assertEqual([line_number for line_number, _ in importer.errors], [32, 33])
+        orders = Order.objects.filter(pk__gt=last_pk)
+        self.assertEqual(orders.filter(sales_rep=self.sales_reps[0], status=Order.DISPATCHED).count(), 10)
+        self.assertEqual(orders.filter(sales_rep=self.sales_reps[0], status=Order.PROCESSING).count(), 1)
+        self.assertEqual(OrderedProduct.objects.filter(order__in=orders).count(), 31)
+        self.assertEqual(OutboxMessage.objects.count(), 11)
+
+    def test_query_count_per_batch(self):
+        # The lookups are shared between batches, so only the first batch queries them
+        with CaptureQueriesContext(connection) as context:
+            OrderImporter(batch_size=10).run(read_rows(self.get_csv(10), 'csv'))
+        with CaptureQueriesContext(connection) as many_context:
+            OrderImporter(batch_size=10).run(read_rows(self.get_csv(100), 'csv'))
+        self.assertLessEqual(len(many_context.captured_queries), 10 * len(context.captured_queries))
+
+
+class OrderTransitionTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=300, lines_per_order=2)
+
+    def test_transition_orders(self):
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        with self.assertNumQueries(1):
+            moved = transition_orders(Order.objects.all(), Order.DISPATCHED)
+        self.assertEqual(moved, sum(status != Order.DISPATCHED for status in statuses.values()))
+        self.assertFalse(Order.objects.exclude(status=Order.DISPATCHED).exists())
+        self.assertEqual(transition_orders(Order.objects.all(), Order.PROCESSING), 0)
+
+        flush_pending_rollup_refresh()
+        rollups = {rollup.key: rollup.amount for rollup in MonthlySalesRollup.objects.all()}
+        self.assertEqual(rollups, MonthlySalesRollup.get_live_totals())
+
+    def test_transition_skips_disallowed_sources(self):
+        awaiting = Order.objects.filter(status=Order.AWAITING_CUSTOMER_RESPONSE)
+        expected = set(awaiting.values_list('pk', flat=True))
+        self.assertEqual(transition_orders(Order.objects.all(), Order.PROCESSING), len(expected))
+        self.assertTrue(expected <= set(Order.objects.filter(status=Order.PROCESSING).values_list('pk', flat=True)))
+        self.assertEqual(Order.objects.filter(status=Order.AWAITING_CUSTOMER_RESPONSE).count(), 0)
+        with self.assertRaises(ValueError):
+            transition_orders(Order.objects.all(), 'shipped')
+
+
+class ProfilingTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=30, lines_per_order=1)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def test_profile(self):
+        with self.assertLogs('prolife.core.profiling', 'INFO') as logs:
+            with profile('outer', job='test') as outer:
+                Order.objects.count()
+                with profile('inner') as inner, span('render'):
+                    list(Order.objects.all())
+        self.assertEqual((outer.query_count, inner.query_count), (2, 1))
+        self.assertEqual(list(inner.spans), ['render'])
+        records = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual([record['name'] for record in records], ['inner', 'outer'])
+        self.assertEqual(records[1]['job'], 'test')
+        self.assertIn('core_order', records[1]['slowest_query'])
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_middleware(self):
+        self.client.force_login(self.superuser)
+        with self.assertLogs('prolife.core.profiling', 'INFO') as logs:
+            response = self.client.get(reverse('admin:core_order_changelist'))
+        self.assertRegex(response['Server-Timing'], r'^sql;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['view'], record['status']), ('admin:core_order_changelist', 200))
+
+
+@override_settings(METRICS_REDIS_URL='', CELERY_BROKER_URL='', METRICS_TOKEN='secret')
+class MetricsTest(TestCase):
+
+    def test_histogram_buckets_are_cumulative(self):
+        lines = list(get_histogram_lines('email_smtp_seconds', {
+            'template="a"|0.05': '2',
+            'template="a"|1.0': '1',
+            'template="a"|+Inf': '1',
+            'template="a"|sum': '31.5',
+        }))
+        self.assertIn('email_smtp_seconds_bucket{template="a",le="0.01"} 0', lines)
+        self.assertIn('email_smtp_seconds_bucket{template="a",le="0.05"} 2', lines)
+        self.assertIn('email_smtp_seconds_bucket{template="a",le="120.0"} 3', lines)
+        self.assertIn('email_smtp_seconds_bucket{template="a",le="+Inf"} 4', lines)
+        self.assertEqual(lines[-2:], ['email_smtp_seconds_sum{template="a"} 31.5', 'email_smtp_seconds_count{template="a"} 4'])
+
+    def test_metrics_view_requires_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE celery_task_queue_seconds histogram', response.content.decode())
+
+    @override_settings(METRICS_REDIS_URL='redis://localhost:1/0', CELERY_BROKER_URL='redis://localhost:1/0')
+    def test_metrics_view_without_redis(self):
+        with self.assertLogs('prolife.core.metrics', 'WARNING'):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('metrics_redis_up 0\n', content)
+        self.assertIn('# TYPE celery_task_queue_seconds histogram', content)
+        self.assertNotIn('celery_queue_length{', content)
+
+    @override_settings(METRICS_REDIS_URL='redis://localhost:1/0', METRICS_REDIS_TIMEOUT=0.1)
+    def test_observations_skip_a_failing_redis(self):
+        options = get_metrics_redis().connection_pool.connection_kwargs
+        self.assertEqual((options['socket_connect_timeout'], options['socket_timeout']), (0.1, 0.1))
+        client = mock.Mock()
+        client.pipeline.return_value.execute.side_effect = redis.ConnectionError
+        with mock.patch.object(metrics, '_redis_unavailable_until', 0.0):
+            with mock.patch('prolife.core.metrics.get_metrics_redis', return_value=client):
+                with self.assertLogs('prolife.core.metrics', 'WARNING') as logs:
+                    observe('email_smtp_seconds', 1, template='a')
+                    # Dropped without trying the Redis again
+                    observe('email_smtp_seconds', 1, template='a')
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(client.pipeline.return_value.execute.call_count, 1)
+
+
+class SyntheticDataTest(TestCase):
+
+    def test_generate_synthetic_data(self):
+        generate_synthetic_data(customers=30, products=20, sales_reps=3, orders=200, years=3, lines_per_order=4)
+        self.assertEqual(
+            [Customer.objects.count(), Product.objects.count(), User.objects.count(), Order.objects.count()],
+            [30, 20, 3, 200],
+        )
+        lines = OrderedProduct.objects.values('order').annotate(count=Count('id')).values_list('count', flat=True)
+        self.assertEqual(len(lines), 200)
+        self.assertTrue(all(1 <= count <= 4 for count in lines))
+        self.assertGreater(Order.objects.filter(status=Order.DISPATCHED).count(), 100)
+        rollups = {rollup.key: rollup.amount for rollup in MonthlySalesRollup.objects.all()}
+        self.assertEqual(rollups, MonthlySalesRollup.get_live_totals())
+
+
+class ConnectionHealthCheckTest(TransactionTestCase):
+
+    def test_close_unhealthy_connections(self):
+        Order.objects.exists()
+        healthy = connection.connection
+        close_unhealthy_connections()
+        self.assertIs(connection.connection, healthy)
+        # Stands in for the server dropping the connection
+        healthy.close()
+        close_unhealthy_connections()
+        self.assertIsNone(connection.connection)
+        self.assertFalse(Order.objects.exists())
+
+
+class SalesReportCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=60, lines_per_order=2)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.year = timezone.localdate().year
+
+    def setUp(self):
+        cache.clear()
+
+    def get_report(self):
+        with mock.patch('prolife.core.reports.build_sales_report', wraps=build_sales_report) as build:
+            report = get_sales_report(self.year)
+        return report, build.call_count
+
+    def hold_lock(self):
+        cache.add(f'sales_report:{SALES_REPORT_FORMAT}:{self.year}:{get_sales_report_version()}:lock', 1)
+
+    def test_miss_builds_the_report_once(self):
+        report, builds = self.get_report()
+        self.assertEqual(builds, 1)
+        cached, builds = self.get_report()
+        self.assertEqual(builds, 0)
+        self.assertEqual(cached['sales_rep_report'].as_dict(), report['sales_rep_report'].as_dict())
+
+    def test_invalidated_report_is_rebuilt(self):
+        self.get_report()
+        order = Order.objects.filter(status=Order.PROCESSING).first()
+        order.status = Order.DISPATCHED
+        order.created_at = timezone.now()
+        order.save()
+        flush_pending_rollup_refresh()
+        report, builds = self.get_report()
+        self.assertEqual(builds, 1)
+        self.assertEqual(
+            report['sales_rep_report'].as_dict(),
+            build_sales_report(self.year)['sales_rep_report'].as_dict(),
+        )
+
+    def test_held_lock_serves_the_stale_report(self):
+        stale, _ = self.get_report()
+        invalidate_sales_report()
+        self.hold_lock()
+        report, builds = self.get_report()
+        self.assertEqual(builds, 0)
+        self.assertEqual(report['customers_report'].as_dict(), stale['customers_report'].as_dict())
+
+    @override_settings(SALES_REPORT_LOCK_TIMEOUT=0)
+    def test_held_lock_without_stale_report_builds_after_waiting(self):
+        self.hold_lock()
+        with self.assertLogs('prolife.core.reports', 'WARNING'):
+            _, builds = self.get_report()
+        self.assertEqual(builds, 1)
+
+    def test_missing_snapshot_queues_one_refresh(self):
+        self.client.force_login(self.superuser)
+        with mock.patch('prolife.core.views.refresh_sales_report.delay') as delay:
+            for _ in range(2):
+                self.assertEqual(self.client.get(reverse('sales')).status_code, 200)
+        delay.assert_called_once()
+
+
+class PivotReportTest(SimpleTestCase):
+    # (month, amount, entity) rows with repeated months and tied entity totals
+    ROWS = [
+        (1, Decimal('10.00'), 'a'),
+        (2, Decimal('5.00'), 'b'),
+        (1, Decimal('2.50'), 'a'),
+        (3, Decimal('15.00'), 'c'),
+        (12, Decimal('7.50'), 'b'),
+        (6, Decimal('12.50'), 'd'),
+        (6, Decimal('0.00'), 'e'),
+        (4, Decimal('20.00'), 'f'),
+    ]
+
+    def get_sorted_report(self):
+        """The customer ranking `PivotReport.top()` replaced."""
+        report = get_formatted_report(self.ROWS)
+        return [entity for entity, _ in sorted(report.items(), key=lambda kv: sum(kv[1].values()), reverse=True)]
+
+    def test_as_dict_matches_get_formatted_report(self):
+        self.assertEqual(PivotReport(self.ROWS).as_dict(), get_formatted_report(self.ROWS))
+        self.assertEqual(PivotReport().as_dict(), get_formatted_report([]))
+
+    def test_top_matches_the_sorted_report(self):
+        report = PivotReport(self.ROWS)
+        self.assertEqual(report.top().entities, self.get_sorted_report())
+        self.assertEqual(report.top(3).entities, self.get_sorted_report()[:3])
+        self.assertEqual(report.top().as_dict(), report.as_dict())
+
+    def test_totals(self):
+        report = PivotReport(self.ROWS)
+        self.assertEqual(report.row_totals, [Decimal(total) for total in ('12.50', '12.50', '15.00', '12.50', '0', '20.00')])
+        self.assertEqual(report.column_totals[0], Decimal('12.50'))
+        self.assertEqual(report.grand_total, sum(amount for _, amount, _ in self.ROWS))
+
+
+class SalesBreakdownViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=60, lines_per_order=2)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.end = timezone.localdate()
+        cls.start = cls.end - dt.timedelta(days=SEED_YEARS * 366)
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+
+    def get_breakdown(self, **params):
+        return self.client.get(reverse('sales_breakdown'), {'start': self.start, 'end': self.end, **params})
+
+    def test_invalid_parameters(self):
+        for params in [
+            {'granularity': 'fortnight'},
+            {'group_by': 'county,colour'},
+            {'start': '2020-13-01'},
+            {'end': 'yesterday'},
+        ]:
+            with self.subTest(**params):
+                response = self.get_breakdown(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_requires_superuser(self):
+        self.client.force_login(User.objects.create_user('staff', 'staff@example.com', is_staff=True))
+        self.assertEqual(self.get_breakdown().status_code, 404)
+
+    def test_breakdown(self):
+        response = self.get_breakdown(granularity='year', group_by='sales_rep,county')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['start'][:10], str(self.start))
+        rows = data['rows']
+        self.assertTrue(rows)
+        self.assertEqual(set(rows[0]), {'period', 'sales_rep_email', 'county', 'amount', 'quantity'})
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row['period'], row['sales_rep_email'], row['county'])))
+        dispatched = OrderedProduct.objects.filter(order__status=Order.DISPATCHED)
+        self.assertEqual(sum(Decimal(row['amount']) for row in rows), dispatched.aggregate(total=Sum('line_total'))['total'])
+        self.assertEqual(sum(row['quantity'] for row in rows), dispatched.aggregate(total=Sum('quantity'))['total'])
+
+
+class CsvExportViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=30, lines_per_order=2)
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.end = timezone.localdate()
+        cls.start = cls.end - dt.timedelta(days=SEED_YEARS * 366)
+
+    def setUp(self):
+        self.client.force_login(self.superuser)
+
+    def read_csv(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        return list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+
+    def test_order_lines_export(self):
+        response = self.client.get(reverse('order_lines_export'), {
+            'start': self.start,
+            'end': self.end,
+            'status': Order.DISPATCHED,
+        })
+        self.assertEqual(
+            response['Content-Disposition'],
+            f'attachment; filename="order-lines-{self.start:%Y%m%d}-{self.end:%Y%m%d}.csv"',
+        )
+        header, *rows = self.read_csv(response)
+        self.assertEqual(header, [title for title, _ in ORDER_LINE_COLUMNS])
+        lines = OrderedProduct.objects.filter(order__status=Order.DISPATCHED).select_related('product').order_by('order_id', 'id')
+        self.assertEqual(
+            [(int(row[0]), row[8], row[10], row[12]) for row in rows],
+            [(line.order_id, line.product.sku, str(line.quantity), str(line.line_total)) for line in lines],
+        )
+
+    def test_sales_breakdown_export(self):
+        response = self.client.get(reverse('sales_breakdown_export'), {
+            'start': self.start,
+            'end': self.end,
+            'granularity': 'year',
+            'group_by': 'county',
+        })
+        self.assertEqual(
+            response['Content-Disposition'],
+            f'attachment; filename="sales-{self.start:%Y%m%d}-{self.end:%Y%m%d}.csv"',
+        )
+        header, *rows = self.read_csv(response)
+        self.assertEqual(header, ['period', 'county', 'amount', 'quantity'])
+        total = OrderedProduct.objects.filter(order__status=Order.DISPATCHED).aggregate(total=Sum('line_total'))['total']
+        self.assertEqual(sum(Decimal(row[2]) for row in rows), total)
+
+
+class OrderCreatedEmailTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_orders(orders=3, lines_per_order=2)
+
+    def relay(self):
+        # Runs the email task in place of queueing it
+        with mock.patch.object(send_order_created_messages, 'delay', send_order_created_messages):
+            relay_outbox()
+
+    def test_relayed_message_sends_the_email(self):
+        order = Order.objects.select_related('sales_rep').first()
+        message = OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': order.pk})
+        self.relay()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [order.sales_rep.email])
+        self.assertIn(f'Order ID: {order.pk}', mail.outbox[0].body)
+        message.refresh_from_db()
+        self.assertIsNotNone(message.relayed_at)
+        self.assertIsNotNone(message.delivered_at)
+
+    def test_failing_email_doesnt_stop_the_batch(self):
+        broken = {'subject': 'Broken', 'message': '', 'template_name': 'missing'}
+        emails = [
+            (broken, ['first@example.com'], [], {}, None),
+            (WELCOME_EMAIL, ['second@example.com'], [], {}, None),
+        ]
+        with self.assertLogs('prolife.core.tasks', 'ERROR'):
+            send_email_batch(emails)
+        self.assertEqual([email.to for email in mail.outbox], [['second@example.com']])
+
+    def test_message_is_delivered_once(self):
+        order = Order.objects.first()
+        message = OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': order.pk})
+        send_order_created_messages([message.pk])
+        send_order_created_messages([message.pk])
+        self.assertEqual(len(mail.outbox), 1)
+        message.refresh_from_db()
+        self.assertIsNotNone(message.delivered_at)
+
+    def test_claimed_message_is_skipped(self):
+        order = Order.objects.first()
+        message = OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': order.pk})
+        # Another consumer in the middle of sending it
+        self.assertTrue(OutboxMessage.claim(message.pk))
+        send_order_created_messages([message.pk])
+        self.assertEqual(len(mail.outbox), 0)
+        # Until its claim expired, e.g. as its worker was lost
+        OutboxMessage.objects.filter(pk=message.pk).update(claimed_at=timezone.now() - dt.timedelta(hours=1))
+        send_order_created_messages([message.pk])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def create_relayed_messages(self):
+        messages = [
+            OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': order.pk})
+            for order in Order.objects.order_by('pk')
+        ]
+        with mock.patch.object(send_order_created_messages, 'delay'):
+            relay_outbox()
+        return messages
+
+    def test_failed_email_is_retried(self):
+        messages = self.create_relayed_messages()
+        send = mock.Mock(side_effect=[TemplateDoesNotExist('missing'), None, None])
+        with mock.patch('prolife.core.tasks.send_pooled_email', send), self.assertLogs('prolife.core.tasks', 'ERROR'):
+            send_order_created_messages([message.pk for message in messages])
+        self.assertEqual(send.call_count, 3)
+        failed = OutboxMessage.objects.get(pk=messages[0].pk)
+        self.assertEqual((failed.delivered_at, failed.claimed_at), (None, None))
+        self.assertEqual(round((failed.next_attempt_at - timezone.now()).total_seconds()), settings.OUTBOX_RETRY_DELAY)
+        self.assertEqual(OutboxMessage.objects.filter(delivered_at__isnull=False).count(), 2)
+        OutboxMessage.objects.filter(pk=failed.pk).update(next_attempt_at=timezone.now())
+        self.relay()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(OutboxMessage.objects.filter(delivered_at__isnull=True).exists())
+
+    def test_interrupted_batch_is_relayed_again(self):
+        messages = self.create_relayed_messages()
+        send = mock.Mock(side_effect=[None, SoftTimeLimitExceeded()])
+        with mock.patch('prolife.core.tasks.send_pooled_email', send), self.assertLogs('prolife.core.tasks', 'ERROR'):
+            with self.assertRaises(SoftTimeLimitExceeded):
+                send_order_created_messages([message.pk for message in messages])
+        self.assertEqual(
+            [
+                (message.delivered_at is None, message.claimed_at is None)
+                for message in OutboxMessage.objects.order_by('pk')
+            ],
+            [(False, False), (True, True), (True, True)],
+        )
+        # The undelivered messages are relayed again once their delays passed
+        self.relay()
+        self.assertEqual(len(mail.outbox), 0)
+        OutboxMessage.objects.filter(delivered_at__isnull=True).update(next_attempt_at=timezone.now())
+        self.relay()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(OutboxMessage.objects.filter(delivered_at__isnull=True).exists())
+
+
+class OutboxRelayTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        self.message = OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': 1})
+
+    def relay(self, handler):
+        with mock.patch.dict(OUTBOX_HANDLERS, {OutboxMessage.ORDER_CREATED: handler}):
+            relay_outbox()
+        self.message.refresh_from_db()
+
+    def test_relay(self):
+        handler = mock.Mock()
+        self.relay(handler)
+        handler.assert_called_once_with([self.message])
+        self.assertIsNotNone(self.message.relayed_at)
+        self.relay(handler)
+        handler.assert_called_once()
+
+    @override_settings(OUTBOX_RETRY_DELAY=10, OUTBOX_MAX_RETRY_DELAY=30, OUTBOX_MAX_ATTEMPTS=4)
+    def test_failed_relays_back_off(self):
+        handler = mock.Mock(side_effect=ConnectionError)
+        delays = []
+        for attempt in range(1, 5):
+            with self.assertLogs('prolife.core.tasks', 'ERROR'):
+                self.relay(handler)
+            self.assertEqual((handler.call_count, self.message.attempts), (attempt, attempt))
+            self.assertIsNone(self.message.relayed_at)
+            delays.append(round((self.message.next_attempt_at - timezone.now()).total_seconds()))
+            # Not retried before its delay has passed
+            self.relay(handler)
+            self.assertEqual(handler.call_count, attempt)
+            OutboxMessage.objects.filter(pk=self.message.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(delays, [10, 20, 30, 30])
+        # Given up on after OUTBOX_MAX_ATTEMPTS
+        self.relay(handler)
+        self.assertEqual(handler.call_count, 4)
+        self.assertFalse(OutboxMessage.get_pending().exists())
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_retry_failed_messages(self):
+        OutboxMessage.objects.filter(pk=self.message.pk).update(attempts=2, next_attempt_at=timezone.now())
+        self.client.force_login(self.superuser)
+        changelist_url = reverse('admin:core_outboxmessage_changelist')
+        response = self.client.get(changelist_url, {'state': 'failed'})
+        self.assertEqual([message.pk for message in response.context['cl'].result_list], [self.message.pk])
+        self.client.post(changelist_url, {'action': 'retry_messages', '_selected_action': [self.message.pk]})
+        self.message.refresh_from_db()
+        self.assertEqual((self.message.attempts, self.message.next_attempt_at), (0, None))
+        self.assertEqual(list(OutboxMessage.get_pending()), [self.message])
+
+
+class OutboxRelayLockTest(TransactionTestCase):
+
+    def test_locked_messages_are_skipped(self):
+        messages = [
+            OutboxMessage.objects.create(event=OutboxMessage.ORDER_CREATED, payload={'order_id': i}) for i in range(3)
+        ]
+        locked, released = threading.Event(), threading.Event()
+
+        def hold_lock():
+            # Another relay in the middle of relaying the first message
+            try:
+                with transaction.atomic():
+                    list(OutboxMessage.objects.select_for_update().filter(pk=messages[0].pk))
+                    locked.set()
+                    released.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        self.assertTrue(locked.wait(10))
+        try:
+            with mock.patch.dict(OUTBOX_HANDLERS, {OutboxMessage.ORDER_CREATED: mock.Mock()}):
+                relay_outbox()
+        finally:
+            released.set()
+            thread.join()
+        self.assertEqual(
+            set(OutboxMessage.objects.filter(relayed_at__isnull=False).values_list('pk', flat=True)),
+            {message.pk for message in messages[1:]},
+        )
+
+
+class ProductPricesViewTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = Product.objects.bulk_create(
+            Product(name=f'Product {i}', sku=f'SKU{i:05d}', price=Decimal(i + 1)) for i in range(3)
+        )
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.staff)
+        self.ids = ','.join(str(product.pk) for product in self.products)
+
+    def get_prices(self, **headers):
+        return self.client.get(reverse('product_prices'), {'ids': self.ids}, **headers)
+
+    def test_prices(self):
+        response = self.get_prices()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'])
+        self.assertEqual(
+            {int(pk): product['price'] for pk, product in response.json()['products'].items()},
+            {pk: str(price) for pk, price in Product.objects.values_list('pk', 'price')},
+        )
+
+    def test_unchanged_prices_are_not_modified(self):
+        etag = self.get_prices()['ETag']
+        response = self.get_prices(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_price_change_changes_the_etag(self):
+        etag = self.get_prices()['ETag']
+        product = Product.objects.get(pk=self.products[0].pk)
+        product.price += 1
+        # Run the invalidation scheduled for the commit right away, TestCase never commits
+        with mock.patch('prolife.core.signals.transaction.on_commit', side_effect=lambda func: func()):
+            product.save()
+        response = self.get_prices(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['products'][str(product.pk)]['price'], str(product.price))
+
+    def test_invalid_ids(self):
+        response = self.client.get(reverse('product_prices'), {'ids': '1,x'})
+        self.assertEqual(response.status_code, 400)
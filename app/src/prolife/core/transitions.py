@@ -0,0 +1,41 @@
+from django.db import connections
+
+from prolife.core.models import Order
+from prolife.core.signals import refresh_rollup_on_commit
+
+
+def get_transition_sources(status):
+    """Return the statuses orders can be moved to `status` from."""
+    if status not in dict(Order.STATUS_CHOICES):
+        raise ValueError(f'Unknown status {status!r}')
+    return [source for source, targets in Order.ALLOWED_TRANSITIONS.items() if status in targets]
+
+
+def transition_orders(orders, status):
+    """
+    Move the orders of the `orders` queryset allowed to go to `status` there, return how many moved.
+
+    A single UPDATE checks the current status of every row as it updates it, so orders changed
+    concurrently are skipped rather than moved from a status they're no longer in. No per-order
+    signals are sent: the rollup buckets of the moved orders are refreshed together once the
+    transaction commits.
+    """
+    sources = get_transition_sources(status)
+    if not sources:
+        return 0
+    connection = connections[orders.db]
+    subquery, params = orders.values('pk').order_by().query.sql_with_params()
+    table = connection.ops.quote_name(Order._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {table} SET status = %s WHERE id IN ({subquery}) AND status IN %s '
+            f'RETURNING created_at, sales_rep_id, customer_id',
+            [status, *params, tuple(sources)],
+        )
+        rows = cursor.fetchall()
+    if Order.DISPATCHED in (status, *sources):
+        refresh_rollup_on_commit(
+            Order(created_at=created_at, sales_rep_id=sales_rep_id, customer_id=customer_id).rollup_key
+            for created_at, sales_rep_id, customer_id in rows
+        )
+    return len(rows)
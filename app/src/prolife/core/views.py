@@ -1,35 +1,226 @@
-from django.http import HttpResponse
+import datetime as dt
+from hashlib import md5
+from hmac import compare_digest
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.template import loader
-from django.shortcuts import Http404
-from django.utils.dates import MONTHS
+from django.shortcuts import Http404, redirect
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date
+from django.views.decorators.http import condition, require_POST
 
 from constance import config
 
-from prolife.core.models import Order
-from prolife.utils import get_formatted_report
+from prolife.core.exports import EXPORT_CHUNK_SIZE, csv_response, order_lines_csv_response
+from prolife.core.metrics import format_labels, get_queue_lengths, render_metrics
+from prolife.core.models import Order, Product, SalesReportSnapshot
+from prolife.core.profiling import span
+from prolife.core.reports import get_dimension_columns, get_sales_breakdown
+from prolife.core.search import get_product_version
+from prolife.core.tasks import refresh_sales_report
+from prolife.core.transitions import transition_orders
+from prolife.utils import get_year_range
+
+# Don't enqueue another refresh for the same year while one is probably still running
+REFRESH_QUEUED_TIMEOUT = 60
+# Browser cache lifetime of product prices requested for the current product version
+PRODUCT_PRICES_MAX_AGE = int(dt.timedelta(days=1).total_seconds())
+PRODUCT_PRICES_MAX_IDS = 1000
+
+
+def queue_sales_report_refresh(year):
+    if cache.add(f'sales_report:{year}:refresh_queued', 1, REFRESH_QUEUED_TIMEOUT):
+        refresh_sales_report.delay(year)
+        return True
+    return False
 
 
 def sales(request):
     if request.user.is_superuser:
         YEAR = config.YEAR
 
-        raw_sales_rep_report = Order.get_dispatched_order_in_year_by_sales_rep(YEAR)
-        sales_rep_report = get_formatted_report(raw_sales_rep_report)
-
-        raw_customers_report = Order.get_dispatched_order_in_year_by_customers(YEAR)
-        customers_report = get_formatted_report(raw_customers_report)
-        customers_report = {k: v for k, v in sorted(customers_report.items(), key=lambda kv:sum(kv[1].values()), reverse=True)}
+        snapshot = SalesReportSnapshot.objects.filter(year=YEAR).first()
+        if snapshot is None:
+            queue_sales_report_refresh(YEAR)
 
         context = {
-            'sales_rep_report': sales_rep_report,
-            'customers_report': customers_report,
+            'snapshot': snapshot,
+            'year': YEAR,
             'custom_html': config.CUSTOM_HTML,
-            'months': MONTHS,
             'has_permission': True,
         }
 
         template = loader.get_template('core/report/sales.html')
 
-        return HttpResponse(template.render(context, request))
+        with span('render'):
+            return HttpResponse(template.render(context, request))
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+@require_POST
+def sales_refresh(request):
+    if request.user.is_superuser:
+        if queue_sales_report_refresh(config.YEAR):
+            messages.info(request, "The sales report is being refreshed, reload this page in a moment.")
+        else:
+            messages.info(request, "A refresh of the sales report is already in progress.")
+        return redirect('sales')
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+def get_date_range(request):
+    """
+    Parse the inclusive `start` and `end` dates from the query string into a [start, end) range.
+
+    Both default to the bounds of the configured report year; raises ValueError on malformed dates.
+    """
+    start, end = get_year_range(config.YEAR)
+    try:
+        if request.GET.get('start'):
+            start = timezone.make_aware(dt.datetime.combine(parse_date(request.GET['start']), dt.time()))
+        if request.GET.get('end'):
+            end = timezone.make_aware(dt.datetime.combine(parse_date(request.GET['end']) + dt.timedelta(days=1), dt.time()))
+    except (TypeError, ValueError):
+        raise ValueError('start and end must be dates formatted as YYYY-MM-DD')
+    return start, end
+
+
+def get_breakdown(request):
+    start, end = get_date_range(request)
+    group_by = [dimension for dimension in request.GET.get('group_by', '').split(',') if dimension]
+    rows = get_sales_breakdown(start, end, request.GET.get('granularity', 'month'), group_by)
+    return start, end, group_by, rows
+
+
+def sales_breakdown(request):
+    """
+    JSON sales breakdown, e.g. `?start=2019-01-01&end=2023-12-31&granularity=quarter&group_by=product,county`.
+
+    `start` and `end` are inclusive dates and default to the configured report year.
+    """
+    if request.user.is_superuser:
+        try:
+            start, end, group_by, rows = get_breakdown(request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({
+            'start': start,
+            'end': end,
+            'rows': list(rows),
+        })
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+def sales_breakdown_export(request):
+    """The `sales_breakdown` rows streamed as CSV."""
+    if request.user.is_superuser:
+        try:
+            start, end, group_by, rows = get_breakdown(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        columns = ['period', *get_dimension_columns(group_by), 'amount', 'quantity']
+        return csv_response(
+            f'sales-{start:%Y%m%d}-{end - dt.timedelta(days=1):%Y%m%d}.csv',
+            columns,
+            ([row[column] for column in columns] for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)),
+        )
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+def order_lines_export(request):
+    """Every order line created between `start` and `end`, optionally with a given `status`, streamed as CSV."""
+    if request.user.is_superuser:
+        try:
+            start, end = get_date_range(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        orders = Order.objects.filter(created_at__gte=start, created_at__lt=end)
+        if request.GET.get('status'):
+            orders = orders.filter(status=request.GET['status'])
+        return order_lines_csv_response(orders, f'order-lines-{start:%Y%m%d}-{end - dt.timedelta(days=1):%Y%m%d}.csv')
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+@require_POST
+def order_status_transition(request):
+    """
+    Move the orders with the posted comma separated `ids` to the posted `status` in bulk.
+
+    Orders that can't move to `status` from their current status are left as they are and
+    counted as skipped.
+    """
+    if request.user.is_superuser:
+        try:
+            order_ids = {int(order_id) for order_id in request.POST.get('ids', '').split(',') if order_id}
+        except ValueError:
+            return JsonResponse({'error': 'ids must be a comma separated list of order ids'}, status=400)
+        try:
+            moved = transition_orders(Order.objects.filter(pk__in=order_ids), request.POST.get('status'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'moved': moved, 'skipped': len(order_ids) - moved})
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+def get_product_prices_etag(request):
+    if not request.user.is_staff:
+        return None
+    return f'{get_product_version()}-{md5(request.GET.get("ids", "").encode()).hexdigest()}'
+
+
+@condition(etag_func=get_product_prices_etag)
+def product_prices(request):
+    """
+    Name, SKU and price of the products in `?ids=1,2,3`, used by the order form to total the lines.
+
+    The response only changes with the product version. Requests carrying the current version as
+    `v` are cached by the browser, the others are revalidated against the ETag.
+    """
+    if request.user.is_staff:
+        try:
+            product_ids = {int(product_id) for product_id in request.GET.get('ids', '').split(',') if product_id}
+        except ValueError:
+            return JsonResponse({'error': 'ids must be a comma separated list of product ids'}, status=400)
+        if len(product_ids) > PRODUCT_PRICES_MAX_IDS:
+            return JsonResponse({'error': f'At most {PRODUCT_PRICES_MAX_IDS} ids can be requested'}, status=400)
+        version = get_product_version()
+        products = Product.objects.filter(pk__in=product_ids).values_list('pk', 'name', 'sku', 'price')
+        response = JsonResponse({
+            'version': version,
+            'products': {pk: {'name': name, 'sku': sku, 'price': price} for pk, name, sku, price in products},
+        })
+        if request.GET.get('v') == str(version):
+            patch_cache_control(response, private=True, max_age=PRODUCT_PRICES_MAX_AGE)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+    else:
+        raise Http404("You are not authorized to access this page")
+
+
+def has_metrics_token(request):
+    token = request.META.get('HTTP_AUTHORIZATION', '')[len('Bearer '):]
+    return bool(settings.METRICS_TOKEN) and compare_digest(token, settings.METRICS_TOKEN)
+
+
+def metrics(request):
+    """Celery task and email metrics, and the current queue lengths, for Prometheus to scrape."""
+    if request.user.is_superuser or has_metrics_token(request):
+        gauges = [(
+            'celery_queue_length',
+            'Tasks waiting in a Celery queue.',
+            {format_labels({'queue': queue}): length for queue, length in get_queue_lengths().items()},
+        )]
+        return HttpResponse(render_metrics(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
     else:
         raise Http404("You are not authorized to access this page")
@@ -6,6 +6,7 @@ import datetime as dt
 import environ
 import sentry_sdk
 import logging
+from kombu import Queue
 from sentry_sdk.integrations.django import DjangoIntegration
 from sentry_sdk.integrations.logging import LoggingIntegration
 
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the timings cover the other middleware
+    'prolife.core.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,6 +79,51 @@ WSGI_APPLICATION = 'prolife.wsgi.application'
 DATABASES = {
     'default': env.db(),
 }
+# Seconds a process keeps its connection open for the following requests and tasks, 0 reconnects
+# for each of them. Celery closes the connections it inherits when forking pool processes, so every
+# worker process has its own.
+DATABASES['default']['CONN_MAX_AGE'] = env.int('CONN_MAX_AGE', default=60)
+# Server-side cursors, used by `.iterator()`, don't survive PgBouncer's transaction pooling mode
+DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = env.bool('DATABASE_DISABLE_SERVER_SIDE_CURSORS', default=False)
+# Ping persistent connections before each request and task, so a restarted database doesn't fail them
+DATABASE_HEALTH_CHECKS = env.bool('DATABASE_HEALTH_CHECKS', default=True)
+
+# Cache
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# The sales report is invalidated explicitly on order writes, so it can live long
+SALES_REPORT_CACHE_TIMEOUT = env.int('SALES_REPORT_CACHE_TIMEOUT', default=int(dt.timedelta(days=1).total_seconds()))
+SALES_REPORT_LOCK_TIMEOUT = env.int('SALES_REPORT_LOCK_TIMEOUT', default=60)
+# Admin changelists above this many rows show the planner's row estimate instead of counting them
+ESTIMATED_COUNT_THRESHOLD = env.int('ESTIMATED_COUNT_THRESHOLD', default=100000)
+# Last rows of served changelist pages are kept this long to seek the following pages from
+KEYSET_BOUNDARY_TIMEOUT = env.int('KEYSET_BOUNDARY_TIMEOUT', default=int(dt.timedelta(minutes=10).total_seconds()))
+# Product autocomplete results are cached briefly, any product change invalidates them
+PRODUCT_SEARCH_CACHE_TIMEOUT = env.int('PRODUCT_SEARCH_CACHE_TIMEOUT', default=60)
+
+# Share of the requests whose timings are logged and returned in a Server-Timing header
+PROFILING_SAMPLE_RATE = env.float('PROFILING_SAMPLE_RATE', default=0.1)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # One JSON object per line for the log pipeline to parse
+        'prolife.core.profiling': {
+            'handlers': ['console'],
+            'level': env('PROFILING_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
 
 # Password validation
 
@@ -151,7 +199,63 @@ CELERY_RESULT_EXPIRES = int(dt.timedelta(days=1).total_seconds())
 # Needed for worker monitoring
 CELERY_SEND_EVENTS = True
 
-CELERY_BEAT_SCHEDULE = {}
+# Emails and reports get their own queues and workers so slow SMTP sends and long report builds don't
+# hold up each other. A worker started without -Q consumes all of them.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default'),
+    Queue('email'),
+    Queue('reports'),
+)
+CELERY_TASK_ROUTES = {
+    'prolife.core.tasks.send_email': {'queue': 'email'},
+    'prolife.core.tasks.send_order_created_messages': {'queue': 'email'},
+    'prolife.core.tasks.refresh_sales_report': {'queue': 'reports'},
+    'prolife.core.tasks.precompute_sales_reports': {'queue': 'reports'},
+}
+# Rate limits apply per worker, they keep a burst of single emails from overrunning the SMTP server
+CELERY_TASK_ANNOTATIONS = {
+    'prolife.core.tasks.send_email': {'rate_limit': env('EMAIL_TASK_RATE_LIMIT', default='60/m')},
+    'prolife.core.tasks.precompute_sales_reports': {
+        'soft_time_limit': int(dt.timedelta(minutes=10).total_seconds()),
+        'time_limit': int(dt.timedelta(minutes=11).total_seconds()),
+    },
+    'prolife.core.tasks.refresh_sales_report': {
+        'soft_time_limit': int(dt.timedelta(minutes=5).total_seconds()),
+        'time_limit': int(dt.timedelta(minutes=6).total_seconds()),
+    },
+    # A batch of OUTBOX_BATCH_SIZE emails, each up to two SMTP sends of EMAIL_TIMEOUT
+    'prolife.core.tasks.send_order_created_messages': {
+        'soft_time_limit': int(dt.timedelta(minutes=5).total_seconds()),
+        'time_limit': int(dt.timedelta(minutes=6).total_seconds()),
+    },
+}
+CELERY_TASK_SOFT_TIME_LIMIT = int(dt.timedelta(minutes=2).total_seconds())
+CELERY_TASK_TIME_LIMIT = int(dt.timedelta(minutes=3).total_seconds())
+
+# Tasks are acknowledged once done, so a lost worker's tasks are redelivered, and a worker only reserves
+# the task it runs next instead of holding back tasks idle workers could run
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+CELERY_BEAT_SCHEDULE = {
+    'precompute-sales-reports': {
+        'task': 'prolife.core.tasks.precompute_sales_reports',
+        'schedule': env.int('SALES_REPORT_REFRESH_INTERVAL', default=int(dt.timedelta(minutes=5).total_seconds())),
+    },
+    'relay-outbox': {
+        'task': 'prolife.core.tasks.relay_outbox',
+        'schedule': env.float('OUTBOX_RELAY_INTERVAL', default=5.0),
+    },
+}
+
+# Task and email timings are aggregated here from every process, and scraped from /metrics/
+METRICS_REDIS_URL = env('METRICS_REDIS_URL', default=CELERY_BROKER_URL)
+# Seconds to connect to and wait for the metrics Redis, an unreachable one mustn't hold up tasks and emails
+METRICS_REDIS_TIMEOUT = env.float('METRICS_REDIS_TIMEOUT', default=0.25)
+# Bearer token Prometheus scrapes /metrics/ with, superusers can always see the metrics
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
 
 # default to json serialization only
 CELERY_ACCEPT_CONTENT = ['json']
@@ -178,6 +282,21 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL', default='Monster@prolifedistribution.co.uk')
 
+EMAIL_TIMEOUT = env.int('EMAIL_TIMEOUT', default=30)
+# Seconds a worker keeps its SMTP connection open between messages
+EMAIL_CONNECTION_MAX_IDLE = env.int('EMAIL_CONNECTION_MAX_IDLE', default=60)
+
+# Outbox messages are relayed in batches, a failing message is given up on after OUTBOX_MAX_ATTEMPTS relays
+OUTBOX_BATCH_SIZE = env.int('OUTBOX_BATCH_SIZE', default=100)
+OUTBOX_MAX_ATTEMPTS = env.int('OUTBOX_MAX_ATTEMPTS', default=10)
+# Seconds before retrying a failed relay, doubled with every attempt up to OUTBOX_MAX_RETRY_DELAY, so
+# the default attempts span about an hour and a half of broker downtime
+OUTBOX_RETRY_DELAY = env.int('OUTBOX_RETRY_DELAY', default=10)
+OUTBOX_MAX_RETRY_DELAY = env.int('OUTBOX_MAX_RETRY_DELAY', default=int(dt.timedelta(hours=1).total_seconds()))
+# Seconds before a relayed message that wasn't delivered, e.g. as its worker was lost, is relayed again.
+# Longer than the consumer task's time limit, so a message is never sent by two running tasks.
+OUTBOX_DELIVERY_TIMEOUT = env.int('OUTBOX_DELIVERY_TIMEOUT', default=int(dt.timedelta(minutes=10).total_seconds()))
+
 ORDER_CREATED_TO_EMAILS = env.list('ORDER_CREATED_TO_EMAILS', default=[])
 ORDER_CREATED_CC_EMAILS = env.list('ORDER_CREATED_CC_EMAILS', default=[])
 
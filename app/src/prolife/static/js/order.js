@@ -1,5 +1,11 @@
 (function($){
+    // Product id -> {name, sku, price}, filled from the product prices endpoint
+    var products = {};
+    // Saved line id -> {product, unit_price}, saved lines are totalled at the price they were saved with
+    var savedPrices = {};
+
     $(document).ready(function(){
+        savedPrices = $('.total').data('saved-prices') || {};
         updatePrice();
         $(document).on('change input click', function(e){
             var $target = $(e.target);
@@ -10,19 +16,48 @@
             }
         });
     })
+    function getOrderLines(){
+        var lines = [];
+        $('#orderedproduct_set-group .form-row').each(function (index, row) {
+            var productId = $(row).find('.field-product select').val();
+            var quantity = parseFloat($(row).find('.field-quantity input').val());
+            var saved = savedPrices[$(row).find('input[name$="-id"]').val()];
+            if (productId && !$(row).find('.delete input').is(':checked')) {
+                lines.push({
+                    productId: productId,
+                    quantity: quantity,
+                    // Only while the line keeps its saved product, a new product is saved at its current price
+                    unitPrice: saved && String(saved.product) == productId ? saved.unit_price : null
+                });
+            }
+        });
+        return lines;
+    }
     function updatePrice(){
+        var lines = getOrderLines();
+        var missing = [];
+        $.each(lines, function (index, line) {
+            if (line.unitPrice === null && !(line.productId in products) && missing.indexOf(line.productId) == -1) {
+                missing.push(line.productId);
+            }
+        });
+        if (missing.length) {
+            $.getJSON($('.total').data('prices-url'), {ids: missing.join(',')}).done(function (data) {
+                $.extend(products, data.products);
+                showTotal(getOrderLines());
+            });
+        }
+        showTotal(lines);
+    }
+    function showTotal(lines){
         var orderAmount = parseFloat(0.00);
-        $('#orderedproduct_set-group .form-row').each(function (index, product) {
-                    var price_text = $(product).find('.field-product select').children("option").filter(":selected").text();
-                    if (price_text){
-                        price_text = parseFloat(price_text.slice(price_text.lastIndexOf(' ')+1, price_text.length));
-                    }
-                    var quantity = parseFloat($(product).find('.field-quantity input').val());
-                    if (!isNaN(quantity) && price_text) {
-                        orderAmount += price_text*quantity;
-                    }
-                });
-                $('.order-amount').text(parseFloat(orderAmount).toFixed(2));
+        $.each(lines, function (index, line) {
+            var price = line.unitPrice !== null ? line.unitPrice : (products[line.productId] || {}).price;
+            if (!isNaN(line.quantity) && price !== undefined) {
+                orderAmount += parseFloat(price)*line.quantity;
+            }
+        });
+        $('.order-amount').text(parseFloat(orderAmount).toFixed(2));
     }
 })($);
 /*
@@ -3,11 +3,27 @@ from django.conf.urls.static import static
 from django.contrib.admin.sites import site
 from django.urls import include, path
 
-from prolife.core.views import sales
+from prolife.core.views import (
+    metrics,
+    order_lines_export,
+    order_status_transition,
+    product_prices,
+    sales,
+    sales_breakdown,
+    sales_breakdown_export,
+    sales_refresh,
+)
 
 urlpatterns = [
     path('', site.urls),
-    path('core/report/sales/', sales, name='sales')
+    path('core/report/sales/', sales, name='sales'),
+    path('core/report/sales/refresh/', sales_refresh, name='sales_refresh'),
+    path('core/report/sales/breakdown/', sales_breakdown, name='sales_breakdown'),
+    path('core/report/sales/breakdown/export/', sales_breakdown_export, name='sales_breakdown_export'),
+    path('core/report/orders/export/', order_lines_export, name='order_lines_export'),
+    path('core/orders/transition/', order_status_transition, name='order_status_transition'),
+    path('core/products/prices/', product_prices, name='product_prices'),
+    path('metrics/', metrics, name='metrics'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 site.index_title = ""
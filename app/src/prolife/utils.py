@@ -1,6 +1,63 @@
+import datetime as dt
+import heapq
+import re
 from collections import defaultdict
 from decimal import Decimal
-from functools import partial
+from functools import lru_cache, partial
+
+import redis
+from django.core.cache import cache
+from django.utils import timezone
+
+
+@lru_cache(maxsize=None)
+def get_redis(url, **options):
+    """
+    Return a shared client for the Redis at `url`; clients are thread safe and pool their connections.
+
+    `options` are passed on to the client, e.g. socket timeouts.
+    """
+    return redis.Redis.from_url(url, **options)
+
+
+def get_cache_version(key):
+    """Return the data version stored at cache `key`, part of the keys of everything derived from that data."""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def bump_cache_version(key):
+    """Move everything cached under the data version at `key` to a new version."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def normalize_phone_number(phone_number):
+    """Reduce a UK phone number to its national digits, so '+44 7700 900123' and '07700900123' are equal."""
+    digits = re.sub(r'\D', '', phone_number or '')
+    if digits.startswith('00'):
+        digits = digits[2:]
+    if digits.startswith('44'):
+        digits = digits[2:]
+    return digits.lstrip('0')
+
+
+def get_year_range(year):
+    """Return the [start, end) datetimes of `year` in the current time zone."""
+    return timezone.make_aware(dt.datetime(year, 1, 1)), timezone.make_aware(dt.datetime(year + 1, 1, 1))
+
+
+def get_month_range(year, month):
+    """Return the [start, end) datetimes of `month` in the current time zone."""
+    start = timezone.make_aware(dt.datetime(year, month, 1))
+    if month == 12:
+        return start, timezone.make_aware(dt.datetime(year + 1, 1, 1))
+    return start, timezone.make_aware(dt.datetime(year, month + 1, 1))
 
 
 def get_formatted_report(report):
@@ -15,3 +72,68 @@ def get_formatted_report(report):
             formatted_report[row[2]] = {}
             formatted_report[row[2]][row[0]] = row[1]
     return formatted_report
+
+
+class PivotReport:
+    """
+    Dense entity x month matrix built in a single pass over (month, amount, entity) report rows.
+
+    Row totals, column totals and the grand total are computed once up front, so ranking entities
+    doesn't need to re-sum their months.
+    """
+    MONTHS = 12
+
+    def __init__(self, rows=()):
+        index = {}
+        entities = self.entities = []
+        rows_cells = self.cells = []
+        for month, amount, entity in rows:
+            cells = index.get(entity)
+            if cells is None:
+                cells = index[entity] = [None] * self.MONTHS
+                entities.append(entity)
+                rows_cells.append(cells)
+            current = cells[month - 1]
+            cells[month - 1] = amount if current is None else current + amount
+        self._compute_totals()
+
+    def _compute_totals(self):
+        self.row_totals = []
+        column_totals = [Decimal('0.00')] * self.MONTHS
+        for cells in self.cells:
+            total = Decimal('0.00')
+            for month, amount in enumerate(cells):
+                if amount is not None:
+                    total += amount
+                    column_totals[month] += amount
+            self.row_totals.append(total)
+        self.column_totals = column_totals
+        self.grand_total = sum(self.row_totals, Decimal('0.00'))
+
+    def __len__(self):
+        return len(self.entities)
+
+    @property
+    def table(self):
+        """(entity, month cells, total) rows for rendering; missing months are None."""
+        return zip(self.entities, self.cells, self.row_totals)
+
+    def as_dict(self):
+        """Same shape as `get_formatted_report`: {entity: {month: amount}} with only the months present."""
+        return {
+            entity: {month: amount for month, amount in enumerate(cells, 1) if amount is not None}
+            for entity, cells in zip(self.entities, self.cells)
+        }
+
+    def top(self, limit=None):
+        """Return a new report with entities ordered by total, descending, optionally keeping only `limit`."""
+        key = self.row_totals.__getitem__
+        if limit is None:
+            order = sorted(range(len(self.entities)), key=key, reverse=True)
+        else:
+            order = heapq.nlargest(limit, range(len(self.entities)), key=key)
+        report = PivotReport()
+        report.entities = [self.entities[i] for i in order]
+        report.cells = [self.cells[i] for i in order]
+        report._compute_totals()
+        return report